@@ -0,0 +1,169 @@
+# In-memory stand-in for google.cloud.bigquery.Client, serving the synthetic datasets.
+# Queries are routed by the tables they reference; the paid ledger reads and UPDATEs are
+# emulated in pandas from the query parameters, so the app's paging and filters behave.
+import itertools
+
+import pandas as pd
+
+# Client used by the app while a benchmark runs (see install)
+_active_client = None
+
+
+# Function to read the query parameters of a job config as a {name: value} dict
+def _parameters(job_config):
+    values = {}
+    for parameter in getattr(job_config, "query_parameters", None) or []:
+        values[parameter.name] = getattr(parameter, "value", None)
+        if hasattr(parameter, "values"):
+            values[parameter.name] = parameter.values
+    return values
+
+
+class FakeQueryJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, data_df=None, rows=None, affected_rows=None):
+        self.data_df = data_df
+        self.rows = rows
+        self.job_id = f"fake-job-{next(self._ids)}"
+        self.num_dml_affected_rows = affected_rows
+        self.total_bytes_processed = int(data_df.memory_usage(deep=False).sum()) if data_df is not None else 0
+        self.total_bytes_billed = self.total_bytes_processed
+        self.slot_millis = 0
+        self.cache_hit = False
+        self.destination = None
+
+    def result(self, **kwargs):
+        if self.rows is not None:
+            return list(self.rows)
+        if self.data_df is not None:
+            return self.data_df.to_dict("records")
+        return []
+
+    def to_dataframe(self, **kwargs):
+        # A fresh copy, like a new download would be
+        return self.data_df.copy() if self.data_df is not None else pd.DataFrame()
+
+
+class FakeBigQueryClient:
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.ledger = datasets["paid_ledger"].copy()
+        self.query_count = 0
+
+    def _pending(self, parameters):
+        ledger = self.ledger
+        mask = ledger["sold_date"].isna() & ledger["return_date"].isna()
+        if parameters.get("dealer_code"):
+            mask &= ledger["d_code"] == parameters["dealer_code"]
+        if parameters.get("submitted_by"):
+            mask &= ledger["submitted_by"] == parameters["submitted_by"]
+        if parameters.get("date_from"):
+            mask &= ledger["payment_date"] >= parameters["date_from"]
+        if parameters.get("date_to"):
+            mask &= ledger["payment_date"] <= parameters["date_to"]
+        return ledger[mask]
+
+    def _pending_page(self, parameters):
+        pending = self._pending(parameters).sort_values(["payment_date", "id"], ascending=False)
+        if parameters.get("cursor_date") is not None:
+            cursor_date, cursor_id = parameters["cursor_date"], parameters["cursor_id"]
+            pending = pending[
+                (pending["payment_date"] < cursor_date)
+                | ((pending["payment_date"] == cursor_date) & (pending["id"] < cursor_id))
+            ]
+        return pending.head(parameters.get("page_limit", 100))
+
+    def _completed(self):
+        ledger = self.ledger
+        completed = ledger[ledger["sold_date"].notna() | ledger["return_date"].notna()].copy()
+        completed["status"] = completed["sold_date"].notna().map({True: "مباع", False: "مرتجع"})
+        completed["closed"] = completed["sold_date"].fillna(completed["return_date"])
+        return completed.sort_values("closed", ascending=False).head(10).drop(columns=["closed"])
+
+    def _update(self, query, parameters):
+        ids = set(parameters.get("car_ids") or [])
+        mask = (
+            self.ledger["id"].isin(ids)
+            & self.ledger["sold_date"].isna()
+            & self.ledger["return_date"].isna()
+        )
+        today = pd.Timestamp.now().date()
+        if "sold_date = CURRENT_DATE()" in query:
+            self.ledger.loc[mask, "sold_date"] = today
+        else:
+            self.ledger.loc[mask, "returned"] = True
+            self.ledger.loc[mask, "return_date"] = today
+        return mask
+
+    def query(self, query, job_config=None, **kwargs):
+        self.query_count += 1
+        parameters = _parameters(job_config)
+
+        if query.lstrip().upper().startswith("UPDATE"):
+            return FakeQueryJob(affected_rows=int(self._update(query, parameters).sum()))
+        if "BEGIN TRANSACTION" in query:
+            # Close script: the ids it closed come back as the result rows
+            closed_ids = self.ledger.loc[self._update(query, parameters), "id"]
+            return FakeQueryJob(rows=[{"id": car_id} for car_id in closed_ids])
+        if "INSERT INTO" in query:
+            self.ledger = pd.concat([self.ledger, pd.DataFrame([parameters])], ignore_index=True)
+            return FakeQueryJob(affected_rows=1)
+        if "paid_showroom" in query and "GROUP BY group_key" in query:
+            group_by = query.split("SELECT", 1)[1].split(" AS group_key", 1)[0].strip()
+            breakdown_df = self._pending(parameters).groupby(group_by).agg(
+                pending_count=("id", "size"),
+                total_amount=("payment_amount", "sum"),
+                unique_dealers=("d_code", "nunique")
+            )
+            breakdown_df = breakdown_df.rename_axis("group_key").reset_index()
+            return FakeQueryJob(breakdown_df.sort_values(["total_amount", "group_key"], ascending=[False, True]))
+        if "paid_showroom" in query and "pending_count" in query:
+            pending = self._pending(parameters)
+            return FakeQueryJob(rows=[{
+                "pending_count": len(pending),
+                "total_amount": float(pending["payment_amount"].sum()),
+                "unique_dealers": pending["d_code"].nunique()
+            }])
+        if "paid_showroom" in query and "@page_limit" in query:
+            return FakeQueryJob(self._pending_page(parameters))
+        if "paid_showroom" in query:
+            return FakeQueryJob(self._completed())
+        if "wholesale_car_snapshot" in query:
+            raise LookupError("Not found: wholesale_car_snapshot")
+        if "ajans_wholesale_to_retail_publishing_logs" in query:
+            return FakeQueryJob(self.datasets["car_catalog"])
+        if "vehicle_acquisition_to_selling" in query:
+            return FakeQueryJob(self.datasets["car_catalog"][["sf_vehicle_name"]].rename(
+                columns={"sf_vehicle_name": "car_name"}
+            ))
+        if "showroom_discount_eligibility" in query:
+            return FakeQueryJob(self.datasets["discount_eligibility"])
+        if "showroom_discount" in query:
+            return FakeQueryJob(self.datasets["discount_prices"])
+        if "ajans_dealers.dealers" in query:
+            return FakeQueryJob(self.datasets["dealers"])
+
+        raise ValueError(f"Fake BigQuery client does not know this query: {query[:80]}")
+
+    def insert_rows_json(self, table, rows, row_ids=None):
+        self.ledger = pd.concat([self.ledger, pd.DataFrame(rows)], ignore_index=True)
+        return []
+
+    def load_table_from_json(self, rows, destination, job_config=None):
+        self.ledger = pd.concat([self.ledger, pd.DataFrame(rows)], ignore_index=True)
+        return FakeQueryJob(affected_rows=len(rows))
+
+
+# Function to route the app's BigQuery access to a fake client (returns the client)
+def install(app_module, datasets):
+    global _active_client
+    _active_client = FakeBigQueryClient(datasets)
+    app_module.get_bigquery_client = get_active_client
+    app_module.get_bqstorage_client = lambda: None
+    return _active_client
+
+
+# Function used in place of main.get_bigquery_client while benchmarking
+def get_active_client():
+    return _active_client
@@ -0,0 +1,206 @@
+# Offline benchmark suite for the app's data paths.
+#
+#   python -m benchmarks.run --scales 1000 10000 100000 --output results.json
+#   python -m benchmarks.run --output new.json --compare old.json
+#
+# BigQuery is replaced by an in-memory fake serving seeded synthetic datasets, so results only
+# depend on the code under test. Each case is timed --repeat times and the min/median are kept;
+# the output records the git commit, so runs from different commits can be compared.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Keep every run cold and local: no on-disk snapshots, no snapshot table, a throwaway outbox
+BENCHMARK_ENVIRONMENT = {
+    "REFERENCE_SNAPSHOT_ENABLED": "false",
+    "CAR_SNAPSHOT_ENABLED": "false",
+    "CAR_CATALOG_REFRESH_MODE": "full",
+    "SHOW_ADMIN_PANEL": "false",
+    "WEBHOOK_OUTBOX_PATH": os.path.join(tempfile.mkdtemp(prefix="paid-showroom-bench-"), "outbox.db")
+}
+
+
+# Function to time a callable: returns min/median seconds over the repeats
+def time_case(func, repeat, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return {"min": min(samples), "median": statistics.median(samples), "repeat": repeat}
+
+
+# Function to drop every cached dataset and derived structure, so the next run starts cold
+def clear_app_caches(app):
+    import streamlit as st
+
+    st.cache_data.clear()
+    app.get_car_catalog_state.clear()
+    app.get_reference_cache_state.clear()
+    app.get_search_index.clear()
+
+
+# AppTest script: the app as `streamlit run main.py` would execute it
+def app_script():
+    import main
+
+    main.main()
+
+
+# Function to run the app through AppTest and fail loudly if the script raised
+def run_app(app_test, timeout):
+    app_test.run(timeout=timeout)
+    if app_test.exception:
+        raise RuntimeError(f"App raised: {app_test.exception[0].message}")
+    return app_test
+
+
+# Function to time the data path functions and full app runs at one scale
+def run_scale(app, fake_bigquery, datasets, repeat, app_timeout):
+    from streamlit.testing.v1 import AppTest
+
+    client = fake_bigquery.install(app, datasets)
+    results = {}
+
+    # Loader post-processing (the bodies behind st.cache_data, fake query included)
+    for loader in [app.load_dealers, app.load_car_names, app.load_discount_eligible_cars, app.load_discount_data]:
+        results[f"loader.{loader.__name__}"] = time_case(
+            loader.__wrapped__, repeat, setup=lambda: clear_app_caches(app)
+        )
+
+    clear_app_caches(app)
+    dealers_df = app.load_dealers.__wrapped__()
+    cars_df = app.load_car_names.__wrapped__()
+    eligible_df = app.load_discount_eligible_cars.__wrapped__()
+    discount_df = app.load_discount_data.__wrapped__()
+
+    # Tab3 eligibility join, and option label building for the selectboxes
+    results["build_discount_catalog"] = time_case(lambda: app.build_discount_catalog(eligible_df, discount_df), repeat)
+    results["with_car_option_labels"] = time_case(
+        lambda: app.with_car_option_labels(cars_df.drop(columns=['option_label'])), repeat
+    )
+
+    # Type-ahead search: index build, then prefix and substring lookups
+    results["build_search_index.cars"] = time_case(lambda: app.build_search_index(cars_df['option_label']), repeat)
+    results["build_search_index.dealers"] = time_case(lambda: app.build_search_index(dealers_df['option_label']), repeat)
+    car_index = app.build_search_index(cars_df['option_label'])
+    results["search_index.prefix"] = time_case(lambda: app.search_index(car_index, "C-10", 50), repeat)
+    results["search_index.substring"] = time_case(lambda: app.search_index(car_index, "corolla", 50), repeat)
+
+    # Tab2 ledger page query (keyset paging emulated by the fake backend)
+    results["load_pending_cars_page.100"] = time_case(
+        lambda: app.load_pending_cars_page.__wrapped__(None, None, None, None, 100), repeat
+    )
+
+    # Whole app through AppTest: cold first run, warm rerun, then the management section with
+    # 100 rows per page and the discount section
+    script = AppTest.from_function(app_script)
+    results["app.cold_run"] = time_case(
+        lambda: run_app(AppTest.from_function(app_script), app_timeout), repeat, setup=lambda: clear_app_caches(app)
+    )
+    run_app(script, app_timeout)
+    results["app.warm_rerun"] = time_case(lambda: run_app(script, app_timeout), repeat)
+    run_app(script.radio(key="active_section").set_value("paid_management"), app_timeout)
+    results["app.pending_page_100"] = time_case(
+        lambda: run_app(script.selectbox(key="pending_page_size").set_value(100), app_timeout), repeat
+    )
+    results["app.discount_section"] = time_case(
+        lambda: run_app(script.radio(key="active_section").set_value("discount"), app_timeout), repeat
+    )
+    results["app.discount_fleet_table"] = time_case(
+        lambda: run_app(script.radio(key="discount_view").set_value("fleet"), app_timeout), repeat
+    )
+
+    results["fake_bigquery.queries"] = client.query_count
+    return results
+
+
+# Function to describe the code and environment the results belong to
+def describe_environment():
+    import pandas as pd
+    import streamlit as st
+
+    def git(*args):
+        try:
+            return subprocess.run(
+                ["git", *args], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--", "main.py")),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "streamlit": st.__version__,
+        "platform": platform.platform(),
+        "created_at": datetime.now().isoformat(timespec="seconds")
+    }
+
+
+# Function to print a side by side comparison of two result files (median seconds)
+def print_comparison(old, new):
+    print(f"{'case':48} {'old':>10} {'new':>10} {'ratio':>7}")
+    for scale, cases in new["results"].items():
+        old_cases = old["results"].get(scale, {})
+        for case, timing in cases.items():
+            if not isinstance(timing, dict) or not isinstance(old_cases.get(case), dict):
+                continue
+            old_median, new_median = old_cases[case]["median"], timing["median"]
+            ratio = new_median / old_median if old_median else float("inf")
+            print(f"{scale + ' ' + case:48} {old_median:10.4f} {new_median:10.4f} {ratio:6.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Offline benchmarks for main.py")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Row counts of the synthetic catalog and ledger")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic datasets")
+    parser.add_argument("--app-timeout", type=float, default=120, help="Seconds allowed per AppTest run")
+    parser.add_argument("--output", metavar="FILE", help="Write the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="Compare against an earlier results file")
+    args = parser.parse_args(argv)
+
+    os.environ.update(BENCHMARK_ENVIRONMENT)
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+
+    import main as app
+    from benchmarks import fake_bigquery
+    from benchmarks.synthetic import make_datasets
+
+    report = {"environment": describe_environment(), "seed": args.seed, "results": {}}
+    for scale in args.scales:
+        print(f"scale {scale}...", file=sys.stderr)
+        report["results"][str(scale)] = run_scale(
+            app, fake_bigquery, make_datasets(scale, args.seed), args.repeat, args.app_timeout
+        )
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as compare_file:
+            print_comparison(json.load(compare_file), report)
+    else:
+        print(json.dumps(report["results"], indent=2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# Synthetic, seeded datasets shaped like the BigQuery tables the app reads
+import numpy as np
+import pandas as pd
+
+MAKES = {
+    "Toyota": ["Camry", "Corolla", "Yaris", "Fortuner"],
+    "Hyundai": ["Elantra", "Accent", "Tucson", "Creta"],
+    "Nissan": ["Sunny", "Sentra", "Qashqai"],
+    "Kia": ["Cerato", "Sportage", "Picanto"],
+    "Chevrolet": ["Optra", "Aveo", "Lanos"],
+    "Mercedes": ["C 180", "E 200", "GLA 200"]
+}
+
+DEALER_WORDS = ["Auto", "Motors", "Cars", "Trading", "Group", "El Nour", "El Salam", "Misr", "Cairo", "Delta"]
+
+SUBMITTERS = ["Nawal Mostafa", "Mai Yousif", "Mamdouh", "test"]
+
+
+# Function to generate the dealers table
+def make_dealers(count, seed=0):
+    rng = np.random.default_rng(seed)
+    first = rng.choice(DEALER_WORDS, size=count)
+    second = rng.choice(DEALER_WORDS, size=count)
+    return pd.DataFrame({
+        "dealer_code": [f"D{i:06d}" for i in range(count)],
+        "dealer_name": [f"{a} {b} {i}" for i, (a, b) in enumerate(zip(first, second))]
+    }).sort_values("dealer_name", ignore_index=True)
+
+
+# Function to generate the wholesale car catalog (output of the catalog query)
+def make_car_catalog(count, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    makes = rng.choice(list(MAKES), size=count)
+    models = [MAKES[make][index % len(MAKES[make])] for make, index in zip(makes, rng.integers(0, 100, size=count))]
+    published_at = pd.Timestamp("2024-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 365 * 24 * 3600, size=count), unit="s")
+    return pd.DataFrame({
+        "sf_vehicle_name": [f"C-{10000 + i}" for i in range(count)],
+        "make": makes,
+        "model": models,
+        "year": rng.integers(2010, 2025, size=count),
+        "published_at": published_at,
+        "event_date": published_at.normalize()
+    })
+
+
+# Function to generate the discount eligibility table for a share of the catalog
+def make_discount_eligibility(catalog_df, share=0.5, seed=0):
+    rng = np.random.default_rng(seed + 2)
+    cars = catalog_df.sample(frac=share, random_state=seed)["sf_vehicle_name"].sort_values(ignore_index=True)
+    return pd.DataFrame({
+        "sf_vehicle_name": cars,
+        "showroom_displayed_count": rng.integers(0, 40, size=len(cars)),
+        "days_in_consignment": rng.integers(1, 180, size=len(cars)),
+        "queue_count": rng.integers(0, 10, size=len(cars)),
+        "discount_eligibility_flag": True,
+        "car_status": rng.choice(["Published", "Being Sold"], size=len(cars))
+    })
+
+
+# Function to generate discount prices for a share of the catalog (partly overlapping eligibility)
+def make_discount_prices(catalog_df, share=0.6, seed=0):
+    rng = np.random.default_rng(seed + 3)
+    cars = catalog_df.sample(frac=share, random_state=seed + 1)["sf_vehicle_name"].sort_values(ignore_index=True)
+    consignment = rng.integers(300, 3000, size=len(cars)) * 1000.0
+    speed = consignment * rng.uniform(0.85, 0.98, size=len(cars))
+    flash = speed * rng.uniform(0.9, 0.99, size=len(cars))
+    return pd.DataFrame({
+        "c_code": cars,
+        "flash_price": flash.round(-2),
+        "consignment_price": consignment,
+        "speed_discount_price": speed.round(-2)
+    })
+
+
+# Function to generate the paid_showroom ledger (about a third of the rows still pending)
+def make_paid_ledger(count, catalog_df, dealers_df, seed=0):
+    rng = np.random.default_rng(seed + 4)
+    payment_date = pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 700, size=count), unit="D")
+    outcome = rng.choice(["pending", "sold", "returned"], size=count, p=[0.35, 0.5, 0.15])
+    closed_date = payment_date + pd.to_timedelta(rng.integers(1, 60, size=count), unit="D")
+
+    ledger_df = pd.DataFrame({
+        "id": [f"{i:08x}-0000-4000-8000-{i:012x}" for i in range(count)],
+        "c_name": rng.choice(catalog_df["sf_vehicle_name"].to_numpy(), size=count),
+        "d_code": rng.choice(dealers_df["dealer_code"].to_numpy(), size=count),
+        "payment_date": payment_date.date,
+        "payment_amount": rng.integers(10, 500, size=count) * 1000.0,
+        "date_of_payment": payment_date.date,
+        "sold_date": np.where(outcome == "sold", closed_date.date, None),
+        "returned": np.where(outcome == "returned", True, None),
+        "return_date": np.where(outcome == "returned", closed_date.date, None),
+        "request_id": None,
+        "submitted_by": rng.choice(SUBMITTERS, size=count)
+    })
+    return ledger_df
+
+
+# Function to build every dataset for one benchmark scale
+def make_datasets(scale, seed=0):
+    dealers_df = make_dealers(max(scale // 10, 10), seed)
+    catalog_df = make_car_catalog(scale, seed)
+    return {
+        "dealers": dealers_df,
+        "car_catalog": catalog_df,
+        "discount_eligibility": make_discount_eligibility(catalog_df, seed=seed),
+        "discount_prices": make_discount_prices(catalog_df, seed=seed),
+        "paid_ledger": make_paid_ledger(scale, catalog_df, dealers_df, seed)
+    }
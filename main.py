@@ -3,8 +3,31 @@ import pandas as pd
 from google.oauth2 import service_account
 from datetime import datetime
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import pyarrow.feather as feather
+import pyarrow.parquet as parquet
+from pyarrow import csv as arrow_csv
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import closing
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_left
+from requests.adapters import HTTPAdapter
+import threading
+import functools
+import argparse
+import tempfile
 import requests
+import sqlite3
+import logging
+import random
+import json
+import time
+import types
 import uuid
+import sys
+import os
 
 # Set page config
 st.set_page_config(
@@ -14,165 +37,737 @@ st.set_page_config(
 )
 
 
-# Function to load dealer data from BigQuery
-@st.cache_data(ttl=600)  # Cache data for 10 minutes
-def load_dealers():
+# n8n webhook endpoints
+PAYMENT_WEBHOOK_URL = "https://anasalaa.app.n8n.cloud/webhook/e4ddbc51-cbb1-4cff-b88a-1062a3ab2cc7"
+DISCOUNT_WEBHOOK_URL = "https://anasalaa.app.n8n.cloud/webhook/9296d4cc-ca48-4bd6-9635-3ef4029b0fce"
+
+# Headers sent with the discount webhook
+DISCOUNT_WEBHOOK_HEADERS = {
+    'Content-Type': 'application/json',
+    'Accept': 'application/json',
+    'User-Agent': 'Streamlit-Showroom-Discount/1.0'
+}
+
+# Retry schedule for webhook deliveries from the outbox (exponential backoff, capped)
+WEBHOOK_RETRY_BASE_SECONDS = 5
+WEBHOOK_RETRY_MAX_SECONDS = 900
+
+# Sources of the car catalog that the incremental refresh reads past its watermarks
+CAR_PUBLISHING_LOGS_TABLE = "ajans_dealers.ajans_wholesale_to_retail_publishing_logs"
+CAR_ACTIVITY_TABLE = "ajans_dealers.vehicle_activity"
+
+# Precomputed wholesale car catalog written by `python main.py build-car-snapshot`
+CAR_SNAPSHOT_TABLE = "pricing-338819.wholesale_test.wholesale_car_snapshot"
+
+# Paid cars ledger (the paid_showroom_table setting points the app at another copy, e.g. during
+# `python main.py migrate-paid-ledger`)
+PAID_SHOWROOM_TABLE = "pricing-338819.wholesale_test.paid_showroom"
+
+# People allowed to submit payments
+SUBMITTER_OPTIONS = ["Nawal Mostafa", "Mai Yousif", "Mamdouh", "test"]
+
+# Page sizes offered in the pending cars listing
+PENDING_PAGE_SIZE_OPTIONS = [10, 25, 50, 100]
+
+# Schema of the paid_showroom table (used by the bulk import load job)
+PAID_SHOWROOM_SCHEMA = [
+    bigquery.SchemaField("id", "STRING"),
+    bigquery.SchemaField("c_name", "STRING"),
+    bigquery.SchemaField("d_code", "STRING"),
+    bigquery.SchemaField("payment_date", "DATE"),
+    bigquery.SchemaField("payment_amount", "NUMERIC"),
+    bigquery.SchemaField("date_of_payment", "DATE"),
+    bigquery.SchemaField("sold_date", "DATE"),
+    bigquery.SchemaField("returned", "BOOL"),
+    bigquery.SchemaField("return_date", "DATE"),
+    bigquery.SchemaField("request_id", "STRING"),
+    bigquery.SchemaField("submitted_by", "STRING")
+]
+
+# Columns required in a payment import file (submitted_by is optional)
+PAYMENT_IMPORT_COLUMNS = ['c_name', 'd_code', 'payment_amount', 'date_of_payment']
+
+# Ledger statuses offered by the full-history export, with their labels
+LEDGER_EXPORT_STATUSES = {
+    "pending": "معلق",
+    "sold": "مباع",
+    "returned": "مرتجع"
+}
+
+# Namespace of the payment ids derived from the contents of imported rows (see build_import_payments)
+PAYMENT_IMPORT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "paid-showroom/payment-import")
+
+# Columns the pending cars summary can be broken down by, with their labels
+PENDING_BREAKDOWN_COLUMNS = {
+    "d_code": "حسب التاجر",
+    "submitted_by": "حسب المرسل"
+}
+
+# Error shown for each reference loader when it fails with nothing to serve
+REFERENCE_LOAD_ERRORS = {
+    "load_dealers": "خطأ في تحميل بيانات التجار",
+    "load_car_names": "خطأ في تحميل بيانات السيارات",
+    "load_discount_eligible_cars": "خطأ في تحميل بيانات السيارات المؤهلة للخصم",
+    "load_discount_data": "خطأ في تحميل بيانات الخصم"
+}
+
+
+# Function to read an optional app setting (Streamlit secrets first, then environment variables)
+def get_setting(name, default=None):
     try:
-        # Get credentials for BigQuery
-        try:
-            credentials = service_account.Credentials.from_service_account_info(
-                st.secrets["service_account"]
-            )
-        except (KeyError, FileNotFoundError):
-            try:
-                credentials = service_account.Credentials.from_service_account_file(
-                    'service_account.json'
-                )
-            except FileNotFoundError:
-                st.error("No credentials found for BigQuery access")
-                return [], {}
-
-        # Create BigQuery client
-        client = bigquery.Client(credentials=credentials)
-
-        # Query to get dealers
-        query = """
-        SELECT DISTINCT dealer_code, dealer_name
-        FROM `pricing-338819.ajans_dealers.dealers`
-        WHERE dealer_code IS NOT NULL AND dealer_name IS NOT NULL
-        ORDER BY dealer_name
-        """
+        return st.secrets[name]
+    except (KeyError, FileNotFoundError):
+        pass
+
+    value = os.environ.get(name.upper())
+    if value is None:
+        return default
+
+    # Environment variables are strings, so cast them to the type of the default
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+# Process-wide registry of background workers. They must not live in st.cache_resource (any user
+# can clear it, which would start a second copy next to the first one), nor in this module's
+# globals (Streamlit re-executes the script on every run), so they are kept on a module object
+# registered once in sys.modules.
+_process_state = sys.modules.setdefault("paid_showroom_process", types.ModuleType("paid_showroom_process"))
+_process_state.__dict__.setdefault("lock", threading.RLock())
+_process_state.__dict__.setdefault("singletons", {})
+
+
+# Function to get a process-wide object, created by factory on first use (at most once per process)
+def process_singleton(name, factory):
+    with _process_state.lock:
+        if name not in _process_state.singletons:
+            _process_state.singletons[name] = factory()
+        return _process_state.singletons[name]
+
+
+# Function to load BigQuery credentials (Streamlit secrets first, then the local key file)
+def load_bigquery_credentials():
+    try:
+        return service_account.Credentials.from_service_account_info(
+            st.secrets["service_account"]
+        )
+    except (KeyError, FileNotFoundError):
+        return service_account.Credentials.from_service_account_file(
+            'service_account.json'
+        )
 
-        # Execute query
-        dealers_data = client.query(query).to_dataframe()
 
-        # Convert to list of dicts for compatibility
-        dealers_list = dealers_data.to_dict('records')
+# Shared BigQuery client, created once per process and reused by every loader and writer.
+# The client keeps its authorized HTTP session (connection pool) alive and refreshes
+# the access token on its own when it expires.
+@st.cache_resource(show_spinner=False)
+def _create_bigquery_client():
+    credentials = load_bigquery_credentials()
+    return bigquery.Client(credentials=credentials, project=credentials.project_id)
+
+
+# Query metrics exposed per query name (Prometheus counter name, totals key)
+QUERY_METRIC_FIELDS = [
+    ("paid_showroom_query_total", "count"),
+    ("paid_showroom_query_errors_total", "errors"),
+    ("paid_showroom_query_seconds_total", "seconds"),
+    ("paid_showroom_query_bytes_processed_total", "bytes_processed"),
+    ("paid_showroom_query_bytes_billed_total", "bytes_billed"),
+    ("paid_showroom_query_slot_milliseconds_total", "slot_ms"),
+    ("paid_showroom_query_bigquery_cache_hits_total", "bigquery_cache_hits"),
+    ("paid_showroom_cache_hits_total", "cache_hits"),
+    ("paid_showroom_cache_misses_total", "cache_misses")
+]
+
+# Names of the cached functions that missed on the current thread (see instrumented_cache_data)
+_cache_misses = threading.local()
+
+
+# Process-wide query metrics: running totals per query name plus a window of recent events.
+# Optionally mirrored to a JSON-lines log (metrics_log_path) and served for scraping in the
+# Prometheus text format on metrics_port (bound to metrics_host, loopback unless opted out).
+# Created once per process (see process_singleton), so clearing the caches neither resets the
+# totals nor leaves the scrape endpoint serving an orphaned copy.
+def get_query_metrics():
+    return process_singleton("query_metrics", create_query_metrics)
+
+
+# Function to create the query metrics state and start its log handler and scrape endpoint
+def create_query_metrics():
+    metrics = {
+        "lock": threading.Lock(),
+        "totals": defaultdict(lambda: defaultdict(float)),
+        "recent": deque(maxlen=500)
+    }
 
-        # Create dealer dictionary
-        dealers_dict = dict(zip(dealers_data['dealer_code'], dealers_data['dealer_name']))
+    log_path = get_setting("metrics_log_path")
+    if log_path:
+        handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        metrics_logger = logging.getLogger("paid_showroom.metrics")
+        metrics_logger.addHandler(handler)
+        metrics_logger.setLevel(logging.INFO)
+        metrics_logger.propagate = False
+
+    port = int(get_setting("metrics_port", 0))
+    if port:
+        start_metrics_server(port, get_setting("metrics_host", "127.0.0.1"))
+
+    return metrics
+
+
+# Function to record one BigQuery call (job statistics are read from the finished job, if any)
+def record_query_metrics(name, seconds, job=None, error=None):
+    event = {
+        "ts": round(time.time(), 3),
+        "query": name,
+        "seconds": round(seconds, 4),
+        "job_id": getattr(job, "job_id", None),
+        "bytes_processed": getattr(job, "total_bytes_processed", None) or 0,
+        "bytes_billed": getattr(job, "total_bytes_billed", None) or 0,
+        "slot_ms": getattr(job, "slot_millis", None) or 0,
+        "bigquery_cache_hit": bool(getattr(job, "cache_hit", False)),
+        "error": error
+    }
 
-        return dealers_list, dealers_dict
+    metrics = get_query_metrics()
+    with metrics["lock"]:
+        totals = metrics["totals"][name]
+        totals["count"] += 1
+        totals["errors"] += 1 if error else 0
+        totals["seconds"] += event["seconds"]
+        totals["bytes_processed"] += event["bytes_processed"]
+        totals["bytes_billed"] += event["bytes_billed"]
+        totals["slot_ms"] += event["slot_ms"]
+        totals["bigquery_cache_hits"] += 1 if event["bigquery_cache_hit"] else 0
+        metrics["recent"].append(event)
+
+    logging.getLogger("paid_showroom.metrics").info(json.dumps(event))
+
+
+# Function to record a Streamlit cache hit or miss for a named cached function
+def record_cache_access(name, hit):
+    metrics = get_query_metrics()
+    with metrics["lock"]:
+        metrics["totals"][name]["cache_hits" if hit else "cache_misses"] += 1
+
+
+# Drop-in replacement for st.cache_data that also counts Streamlit cache hits and misses.
+# The inner wrapper only runs on a miss and flags it for the outer call on the same thread.
+def instrumented_cache_data(name, **cache_kwargs):
+    def decorator(func):
+        @functools.wraps(func)
+        def run_on_miss(*args, **kwargs):
+            _cache_misses.names = getattr(_cache_misses, "names", set()) | {name}
+            return func(*args, **kwargs)
+
+        cached_func = st.cache_data(**cache_kwargs)(run_on_miss)
+
+        @functools.wraps(func)
+        def call_cached(*args, **kwargs):
+            _cache_misses.names = getattr(_cache_misses, "names", set()) - {name}
+            result = cached_func(*args, **kwargs)
+            record_cache_access(name, hit=name not in _cache_misses.names)
+            return result
+
+        call_cached.clear = cached_func.clear
+        return call_cached
+
+    return decorator
+
+
+# Function to render the metrics totals in the Prometheus text format
+def render_prometheus_metrics():
+    metrics = get_query_metrics()
+    with metrics["lock"]:
+        totals = {name: dict(values) for name, values in metrics["totals"].items()}
+
+    lines = []
+    for metric_name, key in QUERY_METRIC_FIELDS:
+        lines.append(f"# TYPE {metric_name} counter")
+        for name, values in sorted(totals.items()):
+            lines.append(f'{metric_name}{{query="{name}"}} {values.get(key, 0):g}')
+    return "\n".join(lines) + "\n"
+
+
+# Function to serve /metrics for scraping from a background thread. The endpoint has no
+# authentication, so it only listens on the loopback interface unless another host is given.
+def start_metrics_server(port, host="127.0.0.1"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
 
-    except Exception as e:
-        st.error(f"خطأ في تحميل بيانات التجار: {str(e)}")
-        return [], {}
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError:
+        logging.getLogger(__name__).warning("Metrics address %s:%s is not available", host, port, exc_info=True)
+        return
 
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
 
-# Function to load discount eligible cars from BigQuery
-@st.cache_data(ttl=600)  # Cache data for 10 minutes
-def load_discount_eligible_cars():
+
+# Function to run a named query, wait for it and record its metrics
+def run_query(client, name, query, job_config=None):
+    started = time.perf_counter()
+    job = None
     try:
-        # Get credentials for BigQuery
-        try:
-            credentials = service_account.Credentials.from_service_account_info(
-                st.secrets["service_account"]
-            )
-        except (KeyError, FileNotFoundError):
-            try:
-                credentials = service_account.Credentials.from_service_account_file(
-                    'service_account.json'
-                )
-            except FileNotFoundError:
-                st.error("No credentials found for BigQuery access")
-                return []
-
-        # Create BigQuery client
-        client = bigquery.Client(credentials=credentials)
-
-        # Query to get discount eligible cars
-        query = """
-        SELECT 
-            sf_vehicle_name,
-            showroom_displayed_count,
-            days_in_consignment,
-            queue_count,
-            discount_eligibility_flag,
-            car_status
-        FROM `pricing-338819.wholesale_test.showroom_discount_eligibility`
-        WHERE discount_eligibility_flag = TRUE
-        ORDER BY sf_vehicle_name
-        """
+        job = client.query(query, job_config=job_config)
+        job.result()
+    except Exception as e:
+        record_query_metrics(name, time.perf_counter() - started, job, error=str(e))
+        raise
+    record_query_metrics(name, time.perf_counter() - started, job)
+    return job
+
+
+# Function to render the query metrics panel (enabled with the show_admin_panel setting)
+def render_query_metrics_panel():
+    if not get_setting("show_admin_panel", False):
+        return
+
+    metrics = get_query_metrics()
+    with metrics["lock"]:
+        totals = {name: dict(values) for name, values in metrics["totals"].items()}
+        recent = list(metrics["recent"])
+
+    with st.sidebar.expander("📈 مقاييس الاستعلامات"):
+        if not totals:
+            st.caption("لا توجد استعلامات مسجلة بعد.")
+            return
+
+        # Every field is present even when only cache hits/misses were recorded so far
+        totals_df = pd.DataFrame.from_dict(totals, orient='index').reindex(
+            columns=[key for _, key in QUERY_METRIC_FIELDS], fill_value=0
+        ).fillna(0)
+        totals_df['avg_seconds'] = totals_df['seconds'] / totals_df['count'].replace(0, 1)
+        st.dataframe(totals_df.sort_values('avg_seconds', ascending=False), use_container_width=True)
+
+        if recent:
+            st.caption("آخر الاستعلامات")
+            st.dataframe(pd.DataFrame(recent[::-1][:50]), hide_index=True, use_container_width=True)
 
-        # Execute query
-        cars_data = client.query(query).to_dataframe()
-        return cars_data.to_dict('records')
 
+# Shared BigQuery Storage read client. Large results are streamed as Arrow record batches
+# instead of paged JSON rows; None when google-cloud-bigquery-storage is not installed.
+@st.cache_resource(show_spinner=False)
+def get_bqstorage_client():
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        return None
+    return bigquery_storage.BigQueryReadClient(credentials=load_bigquery_credentials())
+
+
+# Function to run a named query and fetch its result as a DataFrame over the Storage/Arrow read path.
+# Columns listed in categorical_columns (repeated labels such as make or status) are stored as
+# categories, which keeps the frames, and their cache pickles, small.
+def query_to_frame(client, name, query, job_config=None, categorical_columns=()):
+    started = time.perf_counter()
+    job = None
+    try:
+        job = client.query(query, job_config=job_config)
+        # A hung job fails after query_timeout_seconds instead of blocking its caller forever
+        job.result(timeout=float(get_setting("query_timeout_seconds", 600)) or None)
+        data_df = job.to_dataframe(bqstorage_client=get_bqstorage_client())
     except Exception as e:
-        st.error(f"خطأ في تحميل بيانات السيارات المؤهلة للخصم: {str(e)}")
-        return []
+        record_query_metrics(name, time.perf_counter() - started, job, error=str(e))
+        raise
+    record_query_metrics(name, time.perf_counter() - started, job)
 
+    for column in categorical_columns:
+        if column in data_df.columns:
+            data_df[column] = data_df[column].astype('category')
+    return data_df
 
-# Function to load discount data from BigQuery
-@st.cache_data(ttl=600)  # Cache data for 10 minutes
-def load_discount_data():
+
+# Function to get the shared BigQuery client
+def get_bigquery_client():
     try:
-        # Get credentials for BigQuery
-        try:
-            credentials = service_account.Credentials.from_service_account_info(
-                st.secrets["service_account"]
-            )
-        except (KeyError, FileNotFoundError):
-            try:
-                credentials = service_account.Credentials.from_service_account_file(
-                    'service_account.json'
-                )
-            except FileNotFoundError:
-                st.error("No credentials found for BigQuery access")
-                return []
-
-        # Create BigQuery client
-        client = bigquery.Client(credentials=credentials)
-
-        # Query to get discount data
-        query = """
-        SELECT 
-            c_code,
-            flash_price,
-            consignment_price,
-            speed_discount_price
-        FROM `pricing-338819.wholesale_test.showroom_discount`
-        ORDER BY c_code
-        """
+        return _create_bigquery_client()
+    except FileNotFoundError:
+        # Missing credentials are not cached, so adding them later works without a restart
+        st.error("No credentials found for BigQuery access")
+        return None
+
+
+# Function to get the shared BigQuery client for a cached loader: missing credentials raise, so
+# st.cache_data does not cache an empty result (the caller renders the error)
+def require_bigquery_client():
+    try:
+        return _create_bigquery_client()
+    except FileNotFoundError as e:
+        raise RuntimeError("No credentials found for BigQuery access") from e
+
+
+# Function to get the path of the on-disk snapshot of a reference dataset
+def reference_snapshot_path(name):
+    return os.path.join(get_setting("reference_snapshot_dir", ".reference_cache"), f"{name}.arrow")
+
+
+# Function to read a reference dataset snapshot (Arrow IPC, memory-mapped).
+# Returns None when snapshots are disabled, the file is missing/unreadable, or it is too old
+# (check_age=False accepts a snapshot of any age, as a last resort when BigQuery is failing).
+def read_reference_snapshot(name, check_age=True):
+    if not get_setting("reference_snapshot_enabled", True):
+        return None
+
+    path = reference_snapshot_path(name)
+    try:
+        max_age_seconds = float(get_setting("reference_snapshot_max_age_hours", 24)) * 3600
+        if check_age and time.time() - os.path.getmtime(path) > max_age_seconds:
+            return None
+        return feather.read_table(path, memory_map=True).to_pandas()
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logging.getLogger(__name__).warning("Could not read reference snapshot %s", path, exc_info=True)
+        return None
+
+
+# Function to save a reference dataset snapshot (written to a temp file, then swapped in atomically)
+def write_reference_snapshot(name, data_df):
+    if not get_setting("reference_snapshot_enabled", True):
+        return
+
+    path = reference_snapshot_path(name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        feather.write_feather(data_df.reset_index(drop=True), temp_path, compression="uncompressed")
+        os.replace(temp_path, path)
+    except Exception:
+        logging.getLogger(__name__).warning("Could not write reference snapshot %s", path, exc_info=True)
+
 
-        # Execute query
-        discount_data = client.query(query).to_dataframe()
-        return discount_data.to_dict('records')
+# Process-wide stale-while-revalidate state of the reference datasets: the last good result of
+# each dataset, the refresh currently running for it (at most one), and its last failure time
+@st.cache_resource(show_spinner=False)
+def get_reference_cache_state():
+    return {"lock": threading.Lock(), "entries": {}, "inflight": {}, "failed_at": {}}
 
+
+# Function to run one refresh of a reference dataset and publish the result. A failed refresh
+# keeps the last good result in place; only callers waiting with nothing to serve see the error.
+def refresh_reference_dataset(name, query_fn, future, clear_cache):
+    state = get_reference_cache_state()
+    try:
+        data_df = query_fn()
     except Exception as e:
-        st.error(f"خطأ في تحميل بيانات الخصم: {str(e)}")
-        return []
+        logging.getLogger(__name__).warning("Refresh of %s failed", name, exc_info=True)
+        with state["lock"]:
+            state["inflight"].pop(name, None)
+            state["failed_at"][name] = time.time()
+        future.set_exception(e)
+        return
 
+    write_reference_snapshot(name, data_df)
+
+    with state["lock"]:
+        state["entries"][name] = {"data": data_df, "fetched_at": time.time()}
+        state["inflight"].pop(name, None)
+        state["failed_at"].pop(name, None)
+    future.set_result(data_df)
+
+    # Drop the st.cache_data entries holding the stale result, so the next run picks up this one
+    if clear_cache is not None:
+        clear_cache()
+
+
+# Function to start a refresh of a reference dataset in the background, unless one is already
+# running (single flight). Returns the future of the running refresh; needs the state lock held.
+def start_reference_refresh(state, name, query_fn, clear_cache):
+    future = state["inflight"].get(name)
+    if future is None:
+        future = state["inflight"][name] = Future()
+        threading.Thread(
+            target=refresh_reference_dataset,
+            args=(name, query_fn, future, clear_cache),
+            name=f"refresh-{name}",
+            daemon=True
+        ).start()
+    return future
+
+
+# Function to fetch a reference dataset (stale-while-revalidate, single flight per dataset).
+# A result older than reference_refresh_seconds is still served at once while one background
+# refresh replaces it, so sessions missing st.cache_data together never queue behind BigQuery.
+# Right after a restart the on-disk snapshot plays the part of the last good result. Only when
+# there is nothing to serve do callers wait, all on the same query, for at most
+# reference_timeout_seconds; a failure or timeout then raises.
+def fetch_reference_dataset(name, query_fn, clear_cache):
+    state = get_reference_cache_state()
+    max_age_seconds = float(get_setting("reference_refresh_seconds", 600))
+    retry_seconds = float(get_setting("reference_retry_seconds", 60))
+    timeout_seconds = float(get_setting("reference_timeout_seconds", 120))
+
+    with state["lock"]:
+        entry = state["entries"].get(name)
+        if entry is None:
+            snapshot_df = read_reference_snapshot(name)
+            if snapshot_df is not None:
+                # Served as stale, so it is revalidated right away
+                entry = state["entries"][name] = {"data": snapshot_df, "fetched_at": 0.0}
+
+        if entry is not None:
+            now = time.time()
+            # After a failed refresh, wait retry_seconds before trying BigQuery again
+            if (now - entry["fetched_at"] > max_age_seconds
+                    and now - state["failed_at"].get(name, 0.0) > retry_seconds):
+                start_reference_refresh(state, name, query_fn, clear_cache)
+            return entry["data"]
+
+        # Nothing to serve yet: join the refresh in flight (or start it) and wait for its result
+        future = start_reference_refresh(state, name, query_fn, None)
 
-# Function to load car names from BigQuery
-@st.cache_data(ttl=600)  # Cache data for 10 minutes
-def load_car_names():
     try:
-        # Get credentials for BigQuery
-        try:
-            credentials = service_account.Credentials.from_service_account_info(
-                st.secrets["service_account"]
-            )
-        except (KeyError, FileNotFoundError):
-            try:
-                credentials = service_account.Credentials.from_service_account_file(
-                    'service_account.json'
-                )
-            except FileNotFoundError:
-                st.error("No credentials found for BigQuery access")
-                return []
+        return future.result(timeout=timeout_seconds or None)
+    except Exception as e:
+        # Last resort: a snapshot of any age beats no data at all
+        snapshot_df = read_reference_snapshot(name, check_age=False)
+        if snapshot_df is None:
+            if isinstance(e, FutureTimeoutError):
+                raise TimeoutError(f"Loading {name} timed out after {timeout_seconds:g} seconds") from e
+            raise
+        logging.getLogger(__name__).warning("Serving an expired snapshot of %s", name)
+        with state["lock"]:
+            state["entries"].setdefault(name, {"data": snapshot_df, "fetched_at": 0.0})
+        return snapshot_df
+
+
+# Function to query dealer data from BigQuery
+def query_dealers(client):
+    # Query to get dealers
+    query = """
+    SELECT DISTINCT dealer_code, dealer_name
+    FROM `pricing-338819.ajans_dealers.dealers`
+    WHERE dealer_code IS NOT NULL AND dealer_name IS NOT NULL
+    ORDER BY dealer_name
+    """
+
+    return query_to_frame(client, "dealers", query)
+
+
+# Function to tag a freshly loaded frame with a generation id. The id survives st.cache_data
+# pickling, so structures derived from the frame (search indexes) can be cached per generation.
+def stamp_generation(data_df):
+    data_df.attrs['generation'] = uuid.uuid4().hex
+    return data_df
+
+
+# Function to build a type-ahead index over option labels: lowercase keys sorted for prefix
+# search with bisect, plus bigram and trigram indexes for substring search on make/model/dealer name
+def build_search_index(labels):
+    keys = [str(label).lower() for label in labels]
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+
+    bigrams = defaultdict(list)
+    trigrams = defaultdict(list)
+    for position, key in enumerate(keys):
+        for gram in {key[i:i + 2] for i in range(len(key) - 1)}:
+            bigrams[gram].append(position)
+        for gram in {key[i:i + 3] for i in range(len(key) - 2)}:
+            trigrams[gram].append(position)
+
+    return {
+        "keys": keys,
+        "sorted_keys": [keys[position] for position in order],
+        "order": order,
+        "bigrams": dict(bigrams),
+        "trigrams": dict(trigrams)
+    }
+
+
+# Function to find the top matches in a search index: prefix matches first, then substring matches
+def search_index(index, query, limit):
+    keys = index["keys"]
+    query = query.strip().lower()
+    if not query:
+        return list(range(min(limit, len(keys))))
+
+    # Prefix matches (vehicle / dealer codes) from the sorted keys
+    matches = []
+    sorted_keys = index["sorted_keys"]
+    position = bisect_left(sorted_keys, query)
+    while position < len(sorted_keys) and sorted_keys[position].startswith(query) and len(matches) < limit:
+        matches.append(index["order"][position])
+        position += 1
+
+    if len(matches) >= limit:
+        return matches
+
+    # A single character only matches as a prefix; scanning every key for it would cost O(catalog)
+    if len(query) < 2:
+        return matches
+
+    # Substring matches: the bigram postings of a two-character query, otherwise the intersection
+    # of the trigram postings (smallest first); candidates are verified below
+    if len(query) == 2:
+        candidates = index["bigrams"].get(query, [])
+    else:
+        postings = sorted(
+            (index["trigrams"].get(query[i:i + 3], []) for i in range(len(query) - 2)),
+            key=len
+        )
+        candidates = set(postings[0]).intersection(*postings[1:])
+        candidates = sorted(candidates)
+
+    seen = set(matches)
+    for position in candidates:
+        if position not in seen and query in keys[position]:
+            matches.append(position)
+            if len(matches) >= limit:
+                break
+
+    return matches
+
+
+# Search index per dataset and data generation, shared by every session (no per-rerun copies)
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_search_index(name, generation, _labels):
+    return build_search_index(_labels)
+
+
+# Function to get the row positions of the options matching a search query (top N only)
+def search_options(name, data_df, query):
+    index = get_search_index(name, data_df.attrs.get('generation', len(data_df)), data_df['option_label'])
+    return search_index(index, query or "", get_setting("search_result_limit", 50))
+
+
+# Function to load dealer data from BigQuery. Errors are raised, not returned as an empty frame,
+# so st.cache_data never caches a failure (see load_reference_data).
+@instrumented_cache_data("dealers", ttl=600, show_spinner=False)  # Cache data for 10 minutes
+def load_dealers():
+    # Get the shared BigQuery client
+    client = require_bigquery_client()
+
+    # Execute query (or serve the last good result while it refreshes, see fetch_reference_dataset)
+    dealers_data = fetch_reference_dataset("dealers", lambda: query_dealers(client), load_dealers.clear)
+
+    # One row per dealer code, indexed by code for direct lookups of the dealer name.
+    # The selectbox label is formatted here, once per cache generation, not on every rerun.
+    dealers_data = dealers_data.drop_duplicates(subset='dealer_code', keep='first')
+    dealers_data = dealers_data.assign(
+        option_label=dealers_data['dealer_code'].astype(str) + " - " + dealers_data['dealer_name'].astype(str)
+    )
+    return stamp_generation(dealers_data.set_index('dealer_code', drop=False))
+
+
+# Function to query discount eligible cars from BigQuery
+def query_discount_eligible_cars(client):
+    # Query to get discount eligible cars
+    query = """
+    SELECT 
+        sf_vehicle_name,
+        showroom_displayed_count,
+        days_in_consignment,
+        queue_count,
+        discount_eligibility_flag,
+        car_status
+    FROM `pricing-338819.wholesale_test.showroom_discount_eligibility`
+    WHERE discount_eligibility_flag = TRUE
+    ORDER BY sf_vehicle_name
+    """
+
+    return query_to_frame(client, "discount_eligible_cars", query, categorical_columns=['car_status'])
+
+
+# Function to load discount eligible cars from BigQuery
+@instrumented_cache_data("discount_eligible_cars", ttl=600, show_spinner=False)  # Cache data for 10 minutes
+def load_discount_eligible_cars():
+    # Get the shared BigQuery client
+    client = require_bigquery_client()
 
-        # Create BigQuery client
-        client = bigquery.Client(credentials=credentials)
+    # Execute query (or serve the last good result while it refreshes, see fetch_reference_dataset)
+    return stamp_generation(fetch_reference_dataset(
+        "discount_eligible_cars", lambda: query_discount_eligible_cars(client), load_discount_eligible_cars.clear
+    ).copy(deep=False))
 
-        # Query to get car names with details from live cars
-        query = """
+
+# Function to query discount data from BigQuery
+def query_discount_data(client):
+    # Query to get discount data
+    query = """
+    SELECT 
+        c_code,
+        flash_price,
+        consignment_price,
+        speed_discount_price
+    FROM `pricing-338819.wholesale_test.showroom_discount`
+    ORDER BY c_code
+    """
+
+    return query_to_frame(client, "discount_data", query)
+
+
+# Function to load discount data from BigQuery
+@instrumented_cache_data("discount_data", ttl=600, show_spinner=False)  # Cache data for 10 minutes
+def load_discount_data():
+    # Get the shared BigQuery client
+    client = require_bigquery_client()
+
+    # Execute query (or serve the last good result while it refreshes, see fetch_reference_dataset)
+    return stamp_generation(fetch_reference_dataset(
+        "discount_data", lambda: query_discount_data(client), load_discount_data.clear
+    ).copy(deep=False))
+
+
+# Function to join discount eligible cars with their discount data, indexed by vehicle code
+def build_discount_catalog(eligible_df, discount_df):
+    if eligible_df.empty or discount_df.empty:
+        return pd.DataFrame()
+
+    # One row per vehicle code; the first discount row wins, as with the old linear lookup
+    eligible_df = eligible_df.drop_duplicates(subset='sf_vehicle_name', keep='first')
+    discount_df = discount_df.drop_duplicates(subset='c_code', keep='first')
+
+    catalog = eligible_df.merge(discount_df, left_on='sf_vehicle_name', right_on='c_code', how='inner')
+    catalog['option_label'] = (
+        catalog['sf_vehicle_name'].astype(str) + "  " + catalog['days_in_consignment'].astype(str) + " "
+    )
+
+    # Discount amount and percentage of every car at once (NaN where a price is missing or zero)
+    consignment_price = pd.to_numeric(catalog['consignment_price'], errors='coerce')
+    speed_discount_price = pd.to_numeric(catalog['speed_discount_price'], errors='coerce')
+    consignment_price = consignment_price.where(consignment_price > 0)
+    catalog['discount_amount'] = consignment_price - speed_discount_price.where(speed_discount_price > 0)
+    catalog['discount_pct'] = catalog['discount_amount'] / consignment_price * 100
+
+    return catalog.set_index('sf_vehicle_name', drop=False)
+
+
+# Function to load the pre-joined discount catalog. It is keyed on the generations of its two
+# inputs, so a refresh of either one rebuilds the join instead of serving the old prices.
+@instrumented_cache_data("discount_catalog", ttl=600, max_entries=4)  # Cache data for 10 minutes
+def load_discount_catalog(eligible_generation, discount_generation, _eligible_df, _discount_df):
+    return stamp_generation(build_discount_catalog(_eligible_df, _discount_df))
+
+
+# Function to build the car catalog query
+def build_car_catalog_query():
+    # Query to get car names with details from live cars
+    return f"""
         with publishing AS (
         SELECT sf_vehicle_name,
                publishing_state,
                MAX(published_at) over (partition by sf_vehicle_name) AS max_publish_date
-        FROM ajans_dealers.ajans_wholesale_to_retail_publishing_logs
-        WHERE sf_vehicle_name NOT in ("C-32211","C-32203") 
+        FROM {CAR_PUBLISHING_LOGS_TABLE}
+        WHERE sf_vehicle_name NOT in ("C-32211","C-32203")
         QUALIFY published_at = max_publish_date
         ),
 
@@ -188,8 +783,9 @@ def load_car_names():
                make,
                model,
                year,
+               event_date,
                row_number()over(PARTITION BY sf_vehicle_name ORDER BY event_date DESC) AS row_number
-        FROM ajans_dealers.vehicle_activity )
+        FROM {CAR_ACTIVITY_TABLE})
 
         SELECT *
         FROM max_date WHERE row_number = 1 )
@@ -197,7 +793,9 @@ def load_car_names():
         SELECT DISTINCT publishing.sf_vehicle_name,
                COALESCE(car_info.make, 'Unknown') as make,
                COALESCE(car_info.model, 'Unknown') as model,
-               COALESCE(car_info.year, 0) as year
+               COALESCE(car_info.year, 0) as year,
+               publishing.max_publish_date AS published_at,
+               car_info.event_date AS event_date
         FROM publishing
         LEFT JOIN live_cars ON publishing.sf_vehicle_name = live_cars.sf_vehicle_name
         LEFT JOIN reporting.vehicle_acquisition_to_selling a ON publishing.sf_vehicle_name = a.car_name
@@ -206,120 +804,1314 @@ def load_car_names():
         ORDER BY publishing.sf_vehicle_name
         """
 
+
+# Function to build the incremental car catalog query: one row per car currently in the
+# Wholesale/Published state, with its newest publishing log and activity row at or after the
+# watermarks (NULL when it has none). Only rows past the watermarks are read, filtered on the raw
+# columns so partitioned sources are pruned; for a car with a new row, its newest row is always
+# among them, so the window results match the full query. The status check rides along, so no
+# separate query is needed to drop cars that left the catalog.
+def build_car_catalog_incremental_query():
+    return f"""
+        with new_publishing AS (
+        SELECT sf_vehicle_name,
+               MAX(published_at) AS published_at
+        FROM {CAR_PUBLISHING_LOGS_TABLE}
+        WHERE published_at >= @published_watermark AND sf_vehicle_name NOT in ("C-32211","C-32203")
+        GROUP BY sf_vehicle_name ),
+
+        new_activity AS (
+        SELECT sf_vehicle_name,
+               make,
+               model,
+               year,
+               event_date
+        FROM {CAR_ACTIVITY_TABLE}
+        WHERE event_date >= @event_watermark
+        QUALIFY row_number()over(PARTITION BY sf_vehicle_name ORDER BY event_date DESC) = 1 )
+
+        SELECT a.car_name AS sf_vehicle_name,
+               new_publishing.published_at,
+               new_activity.make,
+               new_activity.model,
+               new_activity.year,
+               new_activity.event_date
+        FROM reporting.vehicle_acquisition_to_selling a
+        LEFT JOIN new_publishing ON a.car_name = new_publishing.sf_vehicle_name
+        LEFT JOIN new_activity ON a.car_name = new_activity.sf_vehicle_name
+        WHERE allocation_category = "Wholesale" AND current_status in ("Published" , "Being Sold")
+        """
+
+
+# Function to build the query of the newest activity row of a few cars (newly published cars
+# whose activity is all older than the event watermark)
+def build_car_activity_lookup_query():
+    return f"""
+        SELECT sf_vehicle_name,
+               make,
+               model,
+               year,
+               event_date
+        FROM {CAR_ACTIVITY_TABLE}
+        WHERE sf_vehicle_name IN UNNEST(@car_names)
+        QUALIFY row_number()over(PARTITION BY sf_vehicle_name ORDER BY event_date DESC) = 1
+        """
+
+
+# Process-wide state of the car catalog used by the incremental refresh
+@st.cache_resource(show_spinner=False)
+def get_car_catalog_state():
+    return {
+        "lock": threading.Lock(),
+        "cars": None,
+        "published_watermark": None,
+        "event_watermark": None,
+        "watermark_types": {},
+        "built_at": 0.0
+    }
+
+
+# Function to get the newest value of a catalog column as a UTC timestamp (None when empty)
+def catalog_watermark(cars_df, column):
+    watermark = pd.to_datetime(cars_df[column], utc=True).max()
+    return None if pd.isnull(watermark) else watermark.to_pydatetime()
+
+
+# Function to build the watermark parameters of the incremental catalog query. Each parameter has
+# the type of its source column (read once from the table schema), so the column is compared as
+# is; a CAST around it would stop BigQuery from pruning partitions.
+def catalog_watermark_parameters(client, published_watermark, event_watermark):
+    watermark_types = get_car_catalog_state()["watermark_types"]
+    parameters = []
+    for name, table, column, watermark in [
+        ("published_watermark", CAR_PUBLISHING_LOGS_TABLE, "published_at", published_watermark),
+        ("event_watermark", CAR_ACTIVITY_TABLE, "event_date", event_watermark)
+    ]:
+        if column not in watermark_types:
+            field_type = next(field.field_type for field in client.get_table(table).schema if field.name == column)
+            watermark_types[column] = field_type if field_type in ("DATE", "DATETIME") else "TIMESTAMP"
+
+        watermark = pd.Timestamp(watermark)
+        if watermark_types[column] == "DATE":
+            value = watermark.date()
+        elif watermark_types[column] == "DATETIME":
+            value = watermark.tz_convert(None).to_pydatetime()
+        else:
+            value = watermark.to_pydatetime()
+        parameters.append(bigquery.ScalarQueryParameter(name, watermark_types[column], value))
+    return parameters
+
+
+# Function to merge the rows of the incremental catalog query into the cached catalog. Every car
+# in the result is still in the catalog's state; it is kept when it was cached or has a new
+# publishing log, and its newer publishing date / activity replace the cached ones.
+def merge_car_catalog_changes(cached_df, changed_df):
+    activity_columns = ['make', 'model', 'year', 'event_date']
+    cached = cached_df.astype({'make': object, 'model': object}).set_index('sf_vehicle_name')
+    changed = changed_df.set_index('sf_vehicle_name')
+
+    keep = changed.index[changed.index.isin(cached.index) | changed['published_at'].notna()]
+    changed = changed.loc[keep]
+    cars_df = cached.reindex(keep)
+
+    has_publishing = changed['published_at'].notna()
+    cars_df.loc[has_publishing, 'published_at'] = changed.loc[has_publishing, 'published_at']
+    has_activity = changed['event_date'].notna()
+    cars_df.loc[has_activity, activity_columns] = changed.loc[has_activity, activity_columns]
+
+    # Same defaults as the COALESCEs of the full query
+    cars_df = cars_df.fillna({'make': 'Unknown', 'model': 'Unknown', 'year': 0})
+    cars_df = cars_df.astype({'make': 'category', 'model': 'category', 'year': cached_df['year'].dtype})
+    return cars_df.reset_index().sort_values('sf_vehicle_name', ignore_index=True)
+
+
+# Function to refresh the car catalog, either with the full query or incrementally.
+# With car_catalog_refresh_mode = "incremental", only source rows at or after the last watermarks
+# are read and merged in, and cars that left the Wholesale/Published state are dropped.
+# A full rebuild still runs every car_catalog_full_rebuild_hours to keep the catalog exact.
+def refresh_car_catalog(client):
+    state = get_car_catalog_state()
+    full_rebuild_seconds = float(get_setting("car_catalog_full_rebuild_hours", 6)) * 3600
+
+    with state["lock"]:
+        needs_full_rebuild = (
+            get_setting("car_catalog_refresh_mode", "full") != "incremental"
+            or state["cars"] is None
+            or state["published_watermark"] is None
+            or state["event_watermark"] is None
+            or time.time() - state["built_at"] > full_rebuild_seconds
+        )
+
+        if needs_full_rebuild:
+            cars_df = query_to_frame(
+                client, "car_catalog_full", build_car_catalog_query(), categorical_columns=['make', 'model']
+            )
+            state["built_at"] = time.time()
+        else:
+            job_config = bigquery.QueryJobConfig(query_parameters=catalog_watermark_parameters(
+                client, state["published_watermark"], state["event_watermark"]
+            ))
+            changed_df = query_to_frame(
+                client, "car_catalog_incremental", build_car_catalog_incremental_query(), job_config
+            ).drop_duplicates(subset='sf_vehicle_name')
+
+            # Newly published cars without recent activity: look up their newest older activity row
+            lookup_cars = changed_df.loc[
+                changed_df['published_at'].notna() & changed_df['event_date'].isna()
+                & ~changed_df['sf_vehicle_name'].isin(state["cars"]['sf_vehicle_name']),
+                'sf_vehicle_name'
+            ]
+            if not lookup_cars.empty:
+                lookup_config = bigquery.QueryJobConfig(query_parameters=[
+                    bigquery.ArrayQueryParameter("car_names", "STRING", lookup_cars.astype(str).tolist())
+                ])
+                lookup_df = query_to_frame(
+                    client, "car_catalog_activity_lookup", build_car_activity_lookup_query(), lookup_config
+                )
+                changed_df = changed_df.set_index('sf_vehicle_name')
+                changed_df.update(lookup_df.set_index('sf_vehicle_name'))
+                changed_df = changed_df.reset_index()
+
+            cars_df = merge_car_catalog_changes(state["cars"], changed_df)
+
+        state["cars"] = cars_df
+        state["published_watermark"] = catalog_watermark(cars_df, 'published_at') or state["published_watermark"]
+        state["event_watermark"] = catalog_watermark(cars_df, 'event_date') or state["event_watermark"]
+
+        return cars_df
+
+
+# Function to materialize the car catalog into the snapshot table, or into a local Parquet file
+def build_car_snapshot(client, local_path=None):
+    if local_path:
+        cars_df = query_to_frame(client, "car_snapshot_build", build_car_catalog_query())
+        cars_df['snapshot_at'] = pd.Timestamp.now(tz='UTC')
+        cars_df.to_parquet(local_path, index=False)
+        return len(cars_df)
+
+    snapshot_query = f"""
+    SELECT catalog.*, CURRENT_TIMESTAMP() AS snapshot_at
+    FROM ({build_car_catalog_query()}) AS catalog
+    """
+    job_config = bigquery.QueryJobConfig(
+        destination=get_setting("car_snapshot_table", CAR_SNAPSHOT_TABLE),
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+    )
+    query_job = run_query(client, "car_snapshot_build", snapshot_query, job_config)
+    return client.get_table(query_job.destination).num_rows
+
+
+# Function to read the car catalog snapshot (table, or the local file set in car_snapshot_path).
+# Off unless car_snapshot_enabled is set, i.e. once the builder runs. Returns None when the
+# snapshot is missing, unreadable or older than car_snapshot_max_age_minutes, so the caller can
+# fall back to the live query; the age is checked on the table / file metadata first, so a stale
+# snapshot is never downloaded.
+def load_car_snapshot(client):
+    if not get_setting("car_snapshot_enabled", False):
+        return None
+
+    max_age = pd.Timedelta(minutes=float(get_setting("car_snapshot_max_age_minutes", 120)))
+    try:
+        local_path = get_setting("car_snapshot_path")
+        if local_path:
+            if not os.path.exists(local_path):
+                return None
+            modified_at = pd.Timestamp(os.path.getmtime(local_path), unit='s', tz='UTC')
+            if pd.Timestamp.now(tz='UTC') - modified_at > max_age:
+                return None
+            snapshot_df = pd.read_parquet(local_path)
+        else:
+            snapshot_table = get_setting("car_snapshot_table", CAR_SNAPSHOT_TABLE)
+            modified_at = client.get_table(snapshot_table).modified
+            if modified_at is None or pd.Timestamp.now(tz='UTC') - pd.Timestamp(modified_at) > max_age:
+                return None
+
+            snapshot_query = f"""
+            SELECT *
+            FROM `{snapshot_table}`
+            ORDER BY sf_vehicle_name
+            """
+            snapshot_df = query_to_frame(client, "car_snapshot_read", snapshot_query, categorical_columns=['make', 'model'])
+    except NotFound:
+        logging.getLogger(__name__).warning("Car snapshot table not found, using the live query")
+        return None
+    except Exception:
+        logging.getLogger(__name__).warning("Car snapshot unavailable, using the live query", exc_info=True)
+        return None
+
+    if snapshot_df.empty:
+        return None
+
+    # The rows carry the build time too (the table can be modified by other means)
+    snapshot_at = pd.to_datetime(snapshot_df['snapshot_at'], utc=True).max()
+    if pd.isnull(snapshot_at) or pd.Timestamp.now(tz='UTC') - snapshot_at > max_age:
+        return None
+
+    return snapshot_df.drop(columns=['snapshot_at'])
+
+
+# Function to query car names: the precomputed snapshot table first, the live query only if it is
+# missing or stale
+def query_car_names(client):
+    cars_data = load_car_snapshot(client)
+    if cars_data is None:
+        # Execute query (full or incremental, see refresh_car_catalog)
+        cars_data = refresh_car_catalog(client)
+    return cars_data
+
+
+# Function to add the selectbox label ("code - make model (year)") to the car catalog
+def with_car_option_labels(cars_df):
+    return stamp_generation(cars_df.assign(
+        option_label=cars_df['sf_vehicle_name'].astype(str) + " - " + cars_df['make'].astype(str) + " "
+        + cars_df['model'].astype(str) + " (" + cars_df['year'].astype(str) + ")"
+    ))
+
+
+# Function to load car names from BigQuery
+@instrumented_cache_data("car_names", ttl=600, show_spinner=False)  # Cache data for 10 minutes
+def load_car_names():
+    # Get the shared BigQuery client
+    client = require_bigquery_client()
+
+    # Execute query (or serve the last good result while it refreshes, see fetch_reference_dataset)
+    cars_data = fetch_reference_dataset("car_names", lambda: query_car_names(client), load_car_names.clear)
+    return with_car_option_labels(cars_data)
+
+
+# Function to get the paid ledger table the app reads and writes
+def paid_showroom_table():
+    return get_setting("paid_showroom_table", PAID_SHOWROOM_TABLE)
+
+
+# Function to tell whether the ledger has the partitioned layout of migrate-paid-ledger:
+# partitioned by payment month, clustered on (status, id), with a status column kept by the app.
+# Every other writer of the ledger (console fixes, backfills, n8n) must keep status in step with
+# the sold/return dates too: 'pending' on insert, 'sold' / 'returned' when closing a car. Reads
+# never trust it alone: the pending list also takes NULL statuses and always checks the dates,
+# and the completed and export queries go by the dates only.
+def paid_showroom_partitioned():
+    return get_setting("paid_showroom_partitioned", False)
+
+
+# Function to get the SET clause fragment keeping the status column (partitioned layout only)
+def status_assignment(status):
+    return f", status = '{status}'" if paid_showroom_partitioned() else ""
+
+
+# Function to build the job config of a paid ledger query. With scan_budget_bytes set, BigQuery
+# itself fails any ledger query billing more than the budget; with scan_budget_dry_run on, the
+# query is also dry-run first, so it fails before running at all.
+def prepare_ledger_query(client, name, query, parameters=()):
+    budget_bytes = int(get_setting("scan_budget_bytes", 0))
+    if budget_bytes and get_setting("scan_budget_dry_run", False):
+        check_scan_budget(client, name, query, parameters, budget_bytes)
+
+    return bigquery.QueryJobConfig(query_parameters=list(parameters), maximum_bytes_billed=budget_bytes or None)
+
+
+# Function to dry-run a query and return the bytes it would process. Raises when that is over
+# budget_bytes (0 = no budget), so a query that stopped pruning fails loudly.
+def check_scan_budget(client, name, query, parameters=(), budget_bytes=0):
+    job_config = bigquery.QueryJobConfig(query_parameters=list(parameters), dry_run=True, use_query_cache=False)
+    scanned_bytes = client.query(query, job_config=job_config).total_bytes_processed or 0
+    if budget_bytes and scanned_bytes > budget_bytes:
+        raise RuntimeError(
+            f"Query {name} would scan {scanned_bytes:,} bytes, over the budget of {budget_bytes:,} bytes"
+        )
+    return scanned_bytes
+
+
+# Function to rebuild the paid ledger into a new table partitioned by payment month and clustered
+# on (status, id), with status derived from the sold/return dates. Checks the row counts match;
+# with swap=True the old table is renamed to <name>_legacy_<date> and the new one takes its name.
+# Returns the lines to print.
+def migrate_paid_ledger(client, target=None, swap=False, dry_run=False):
+    source = paid_showroom_table()
+    target = target or f"{source}_partitioned"
+
+    migration_query = f"""
+    CREATE TABLE `{target}`
+    PARTITION BY DATE_TRUNC(payment_date, MONTH)
+    CLUSTER BY status, id
+    AS
+    SELECT
+        *,
+        CASE
+            WHEN sold_date IS NOT NULL THEN 'sold'
+            WHEN return_date IS NOT NULL THEN 'returned'
+            ELSE 'pending'
+        END AS status
+    FROM `{source}`
+    """
+
+    if dry_run:
+        scanned_bytes = check_scan_budget(client, "migrate_paid_ledger", migration_query)
+        return [migration_query.strip(), f"Would scan {scanned_bytes:,} bytes"]
+
+    run_query(client, "migrate_paid_ledger", migration_query)
+
+    count_query = f"""
+    SELECT
+        (SELECT COUNT(*) FROM `{source}`) AS source_rows,
+        (SELECT COUNT(*) FROM `{target}`) AS target_rows
+    """
+    counts = next(iter(run_query(client, "migrate_paid_ledger_check", count_query).result()))
+    if counts['source_rows'] != counts['target_rows']:
+        raise RuntimeError(
+            f"Row counts differ after the copy: {source} has {counts['source_rows']}, {target} has {counts['target_rows']}"
+        )
+    lines = [f"Copied {counts['target_rows']} rows from {source} to {target}"]
+
+    if swap:
+        legacy_name = f"{source.split('.')[-1]}_legacy_{datetime.now():%Y%m%d}"
+        run_query(client, "migrate_paid_ledger_swap", f"ALTER TABLE `{source}` RENAME TO `{legacy_name}`")
+        run_query(client, "migrate_paid_ledger_swap", f"ALTER TABLE `{target}` RENAME TO `{source.split('.')[-1]}`")
+        lines.append(f"Renamed {source} to {legacy_name} and {target} to {source}")
+        target = source
+
+    lines.append(
+        f"Set paid_showroom_partitioned = true (and paid_showroom_table = {target}) before restarting the app. "
+        "Rows written to the old table after the copy started are not in the new one."
+    )
+    return lines
+
+
+# Function to list the paid ledger queries of the app with representative parameters, for the
+# scan budget check of `python main.py check-scan-budget`
+def build_ledger_budget_queries():
+    sample_cars_df = pd.DataFrame({
+        'id': ["00000000-0000-0000-0000-000000000000"],
+        'payment_date': [datetime.now().date()]
+    })
+    return [
+        ("pending_cars_page", *build_pending_page_query(None, None, None, None, PENDING_PAGE_SIZE_OPTIONS[-1])),
+        ("pending_summary", *build_pending_summary_query(None, None, None, None)),
+        ("pending_breakdown_d_code", *build_pending_breakdown_query("d_code", None, None, None, None)),
+        ("completed_transactions", *build_completed_transactions_query()),
+        ("mark_cars_sold", *build_close_cars_query(sample_cars_df, "sold_date = CURRENT_DATE()" + status_assignment("sold")))
+    ]
+
+
+# Function to build the SQL conditions and parameters for the pending cars filters.
+# On the partitioned layout the status filter lets BigQuery skip the clustered blocks of closed
+# rows (rows inserted without a status are kept; the NULL checks keep the result exact), and the
+# date filters prune partitions.
+def build_pending_filters(dealer_code=None, submitted_by=None, date_from=None, date_to=None):
+    conditions = ["sold_date IS NULL", "return_date IS NULL"]
+    if paid_showroom_partitioned():
+        conditions.insert(0, "(status = 'pending' OR status IS NULL)")
+    parameters = []
+
+    if dealer_code:
+        conditions.append("d_code = @dealer_code")
+        parameters.append(bigquery.ScalarQueryParameter("dealer_code", "STRING", dealer_code))
+
+    if submitted_by:
+        conditions.append("submitted_by = @submitted_by")
+        parameters.append(bigquery.ScalarQueryParameter("submitted_by", "STRING", submitted_by))
+
+    if date_from:
+        conditions.append("payment_date >= @date_from")
+        parameters.append(bigquery.ScalarQueryParameter("date_from", "DATE", date_from))
+
+    if date_to:
+        conditions.append("payment_date <= @date_to")
+        parameters.append(bigquery.ScalarQueryParameter("date_to", "DATE", date_to))
+
+    return conditions, parameters
+
+
+# Function to build the query of one page of pending paid cars.
+# Uses keyset pagination on (payment_date, id): the cursor is the last row of the previous
+# page, so BigQuery never has to skip over earlier pages with OFFSET.
+def build_pending_page_query(dealer_code, submitted_by, date_from, date_to, page_size, cursor=None):
+    conditions, parameters = build_pending_filters(dealer_code, submitted_by, date_from, date_to)
+
+    if cursor is not None:
+        cursor_date, cursor_id = cursor
+        conditions.append(
+            "(payment_date < @cursor_date OR (payment_date = @cursor_date AND id < @cursor_id))"
+        )
+        parameters.append(bigquery.ScalarQueryParameter("cursor_date", "DATE", cursor_date))
+        parameters.append(bigquery.ScalarQueryParameter("cursor_id", "STRING", cursor_id))
+
+    # Fetch one extra row to know whether there is a next page
+    parameters.append(bigquery.ScalarQueryParameter("page_limit", "INT64", page_size + 1))
+
+    query = f"""
+    SELECT 
+        id,
+        c_name,
+        d_code,
+        payment_date,
+        payment_amount,
+        date_of_payment,
+        sold_date,
+        returned,
+        return_date,
+        request_id,
+        submitted_by
+    FROM `{paid_showroom_table()}`
+    WHERE {" AND ".join(conditions)}
+    ORDER BY payment_date DESC, id DESC
+    LIMIT @page_limit
+    """
+    return query, parameters
+
+
+# Function to load one page of pending paid cars (cached, see invalidate_paid_ledger_cache)
+@instrumented_cache_data("pending_cars_page", ttl=300, show_spinner=False)  # Cache data for 5 minutes
+def load_pending_cars_page(dealer_code, submitted_by, date_from, date_to, page_size, cursor=None):
+    client = get_bigquery_client()
+    if client is None:
+        return pd.DataFrame(), False
+
+    query, parameters = build_pending_page_query(dealer_code, submitted_by, date_from, date_to, page_size, cursor)
+    job_config = prepare_ledger_query(client, "pending_cars_page", query, parameters)
+    page_df = query_to_frame(client, "pending_cars_page", query, job_config)
+
+    return page_df.head(page_size), len(page_df) > page_size
+
+
+# Function to build the summary query of the pending cars matching the filters
+def build_pending_summary_query(dealer_code, submitted_by, date_from, date_to):
+    conditions, parameters = build_pending_filters(dealer_code, submitted_by, date_from, date_to)
+
+    query = f"""
+    SELECT 
+        COUNT(*) AS pending_count,
+        COALESCE(SUM(payment_amount), 0) AS total_amount,
+        COUNT(DISTINCT d_code) AS unique_dealers
+    FROM `{paid_showroom_table()}`
+    WHERE {" AND ".join(conditions)}
+    """
+    return query, parameters
+
+
+# Function to load the summary metrics of the pending cars matching the filters
+@instrumented_cache_data("pending_summary", ttl=300, show_spinner=False)  # Cache data for 5 minutes
+def load_pending_summary(dealer_code, submitted_by, date_from, date_to):
+    client = get_bigquery_client()
+    if client is None:
+        return {'pending_count': 0, 'total_amount': 0, 'unique_dealers': 0}
+
+    query, parameters = build_pending_summary_query(dealer_code, submitted_by, date_from, date_to)
+    job_config = prepare_ledger_query(client, "pending_summary", query, parameters)
+    row = next(iter(run_query(client, "pending_summary", query, job_config).result()))
+
+    return {
+        'pending_count': row['pending_count'],
+        'total_amount': row['total_amount'],
+        'unique_dealers': row['unique_dealers']
+    }
+
+
+# Function to build the query of the pending cars summary per dealer or per submitter.
+# group_by must be one of PENDING_BREAKDOWN_COLUMNS (it is put in the SQL as is).
+def build_pending_breakdown_query(group_by, dealer_code, submitted_by, date_from, date_to):
+    conditions, parameters = build_pending_filters(dealer_code, submitted_by, date_from, date_to)
+
+    query = f"""
+    SELECT 
+        {group_by} AS group_key,
+        COUNT(*) AS pending_count,
+        COALESCE(SUM(payment_amount), 0) AS total_amount,
+        COUNT(DISTINCT d_code) AS unique_dealers
+    FROM `{paid_showroom_table()}`
+    WHERE {" AND ".join(conditions)}
+    GROUP BY group_key
+    ORDER BY total_amount DESC, group_key
+    """
+    return query, parameters
+
+
+# Function to load the pending cars summary per dealer or per submitter (largest totals first).
+# Cached apart from the summary and the row listing, and only queried when a breakdown is shown.
+@instrumented_cache_data("pending_breakdown", ttl=300, show_spinner=False)  # Cache data for 5 minutes
+def load_pending_breakdown(group_by, dealer_code, submitted_by, date_from, date_to):
+    client = get_bigquery_client()
+    if client is None or group_by not in PENDING_BREAKDOWN_COLUMNS:
+        return pd.DataFrame()
+
+    query, parameters = build_pending_breakdown_query(group_by, dealer_code, submitted_by, date_from, date_to)
+    job_config = prepare_ledger_query(client, f"pending_breakdown_{group_by}", query, parameters)
+    return query_to_frame(client, f"pending_breakdown_{group_by}", query, job_config)
+
+
+# Function to build the query of the most recent completed (sold or returned) transactions.
+# On the partitioned ledger only cars paid within completed_lookback_days are considered, so it
+# is pruned to its recent partitions instead of being scanned in full. There is no status filter:
+# a car closed by another writer may still say 'pending'.
+def build_completed_transactions_query():
+    conditions = ["(sold_date IS NOT NULL OR return_date IS NOT NULL)"]
+    parameters = []
+    if paid_showroom_partitioned():
+        conditions.append("payment_date >= DATE_SUB(CURRENT_DATE(), INTERVAL @lookback_days DAY)")
+        parameters.append(
+            bigquery.ScalarQueryParameter("lookback_days", "INT64", int(get_setting("completed_lookback_days", 180)))
+        )
+
+    # Query for recent completed transactions
+    completed_query = f"""
+    SELECT 
+        id,
+        c_name,
+        d_code,
+        payment_date,
+        payment_amount,
+        sold_date,
+        return_date,
+        submitted_by,
+        CASE 
+            WHEN sold_date IS NOT NULL THEN 'مباع'
+            WHEN return_date IS NOT NULL THEN 'مرتجع'
+            ELSE 'معلق'
+        END as status
+    FROM `{paid_showroom_table()}`
+    WHERE {" AND ".join(conditions)}
+    ORDER BY COALESCE(sold_date, return_date) DESC
+    LIMIT 10
+    """
+    return completed_query, parameters
+
+
+# Function to load the most recent completed (sold or returned) transactions
+@instrumented_cache_data("completed_transactions", ttl=300, show_spinner=False)  # Cache data for 5 minutes
+def load_completed_transactions():
+    client = get_bigquery_client()
+    if client is None:
+        return pd.DataFrame()
+
+    completed_query, parameters = build_completed_transactions_query()
+    job_config = prepare_ledger_query(client, "completed_transactions", completed_query, parameters)
+    return query_to_frame(client, "completed_transactions", completed_query, job_config)
+
+
+# Function to build the full-history export query of the paid ledger. Date filters prune the
+# partitions of the partitioned ledger; the status is derived from the sold/return dates.
+def build_ledger_export_query(date_from=None, date_to=None, dealer_code=None, status=None):
+    conditions, parameters = ["TRUE"], []
+
+    if date_from:
+        conditions.append("payment_date >= @date_from")
+        parameters.append(bigquery.ScalarQueryParameter("date_from", "DATE", date_from))
+
+    if date_to:
+        conditions.append("payment_date <= @date_to")
+        parameters.append(bigquery.ScalarQueryParameter("date_to", "DATE", date_to))
+
+    if dealer_code:
+        conditions.append("d_code = @dealer_code")
+        parameters.append(bigquery.ScalarQueryParameter("dealer_code", "STRING", dealer_code))
+
+    if status == "pending":
+        conditions.append("sold_date IS NULL AND return_date IS NULL")
+    elif status == "sold":
+        conditions.append("sold_date IS NOT NULL")
+    elif status == "returned":
+        conditions.append("sold_date IS NULL AND return_date IS NOT NULL")
+
+    query = f"""
+    SELECT 
+        id,
+        c_name,
+        d_code,
+        payment_date,
+        payment_amount,
+        date_of_payment,
+        sold_date,
+        returned,
+        return_date,
+        request_id,
+        submitted_by,
+        CASE 
+            WHEN sold_date IS NOT NULL THEN 'sold'
+            WHEN return_date IS NOT NULL THEN 'returned'
+            ELSE 'pending'
+        END AS status
+    FROM `{paid_showroom_table()}`
+    WHERE {" AND ".join(conditions)}
+    ORDER BY payment_date, id
+    """
+    return query, parameters
+
+
+# Function to stream the paid ledger history matching the filters into a CSV or Parquet file.
+# The result is read page by page as Arrow record batches and each batch is appended to the
+# file, so memory stays bounded by export_page_size whatever the size of the ledger.
+# Returns the number of rows written.
+def export_paid_ledger(client, output_path, file_format="csv", date_from=None, date_to=None,
+                       dealer_code=None, status=None):
+    query, parameters = build_ledger_export_query(date_from, date_to, dealer_code, status)
+    # A full-history export is a full scan by design, so the per-query scan_budget_bytes does not
+    # apply; export_scan_budget_bytes (0 = none) caps it separately
+    budget_bytes = int(get_setting("export_scan_budget_bytes", 0))
+    job_config = bigquery.QueryJobConfig(query_parameters=list(parameters), maximum_bytes_billed=budget_bytes or None)
+    query_job = run_query(client, "export_paid_ledger", query, job_config)
+    rows = query_job.result(page_size=int(get_setting("export_page_size", 50000)))
+
+    writer = None
+    row_count = 0
+    try:
+        for batch in rows.to_arrow_iterable(bqstorage_client=get_bqstorage_client()):
+            if writer is None:
+                if file_format == "parquet":
+                    writer = parquet.ParquetWriter(output_path, batch.schema)
+                else:
+                    writer = arrow_csv.CSVWriter(output_path, batch.schema)
+            writer.write_batch(batch)
+            row_count += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        # No rows: still write the file, with the columns only
+        empty_table = query_job.to_arrow()
+        if file_format == "parquet":
+            parquet.write_table(empty_table, output_path)
+        else:
+            arrow_csv.write_csv(empty_table, output_path)
+
+    return row_count
+
+
+# Function to get the directory holding the prepared export files
+def ledger_export_dir():
+    export_dir = os.path.join(tempfile.gettempdir(), "paid-showroom-exports")
+    os.makedirs(export_dir, exist_ok=True)
+    return export_dir
+
+
+# Function to remove export files older than export_retention_hours (left behind by runs that were
+# interrupted mid-export), so they do not pile up on disk
+def remove_expired_ledger_exports():
+    max_age_seconds = float(get_setting("export_retention_hours", 6)) * 3600
+    export_dir = ledger_export_dir()
+    for file_name in os.listdir(export_dir):
+        path = os.path.join(export_dir, file_name)
         try:
-            # Execute query
-            cars_data = client.query(query).to_dataframe()
-            return cars_data.to_dict('records')
+            if time.time() - os.path.getmtime(path) > max_age_seconds:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+# Function to render the full-history export of the paid ledger (file prepared on request)
+def render_ledger_export(client, dealers_data):
+    with st.expander("📤 تصدير السجل الكامل"):
+        export_col1, export_col2 = st.columns(2)
+        with export_col1:
+            export_dates = st.date_input("نطاق تاريخ الدفع", value=(), key="ledger_export_dates")
+            export_dealer_query = st.text_input("🔍 ابحث عن التاجر (الكود أو الاسم)", key="ledger_export_dealer_search")
+            export_dealer_index = st.selectbox(
+                "التاجر",
+                options=[None] + search_options("dealers", dealers_data, export_dealer_query),
+                format_func=lambda i: "الكل" if i is None else dealers_data['option_label'].iat[i],
+                key="ledger_export_dealer"
+            )
+        with export_col2:
+            export_status = st.selectbox(
+                "الحالة",
+                options=[None] + list(LEDGER_EXPORT_STATUSES),
+                format_func=lambda status: "الكل" if status is None else LEDGER_EXPORT_STATUSES[status],
+                key="ledger_export_status"
+            )
+            export_format = st.radio("صيغة الملف", options=["csv", "parquet"], horizontal=True, key="ledger_export_format")
+
+        if not st.button("تجهيز ملف التصدير", key="ledger_export_prepare"):
+            return
+
+        # The file is written to disk batch by batch, handed to the download button once, then removed
+        remove_expired_ledger_exports()
+        file_handle, export_path = tempfile.mkstemp(suffix=f".{export_format}", dir=ledger_export_dir())
+        os.close(file_handle)
+        try:
+            with st.spinner("جاري تصدير السجل..."):
+                row_count = export_paid_ledger(
+                    client, export_path, export_format,
+                    date_from=export_dates[0] if len(export_dates) > 0 else None,
+                    date_to=export_dates[1] if len(export_dates) > 1 else None,
+                    dealer_code=None if export_dealer_index is None else dealers_data['dealer_code'].iat[export_dealer_index],
+                    status=export_status
+                )
+
+            # The download button holds the whole file in server memory, so large exports go to the CLI
+            max_bytes = float(get_setting("export_ui_max_mb", 200)) * 1024 * 1024
+            if os.path.getsize(export_path) > max_bytes:
+                st.warning(
+                    f"الملف أكبر من الحد المسموح للتحميل من الواجهة ({row_count:,} صف). "
+                    "استخدم: python main.py export-ledger OUTPUT"
+                )
+                return
+
+            with open(export_path, "rb") as export_file:
+                st.download_button(
+                    f"⬇️ تحميل ({row_count:,} صف)",
+                    data=export_file.read(),
+                    file_name=f"paid_showroom_{datetime.now():%Y%m%d_%H%M%S}.{export_format}",
+                    key="ledger_export_download"
+                )
         except Exception as e:
-            # If query fails, provide some sample car names
-            st.warning("Could not load car names from BigQuery. Using sample data.")
-            return [
-                {"sf_vehicle_name": "C-12345", "make": "Toyota", "model": "Camry", "year": 2020},
-                {"sf_vehicle_name": "C-12346", "make": "Honda", "model": "Civic", "year": 2019},
-                {"sf_vehicle_name": "C-12347", "make": "Nissan", "model": "Altima", "year": 2021}
-            ]
+            st.error(f"خطأ في تصدير السجل: {str(e)}")
+        finally:
+            os.remove(export_path)
+
+
+# Function to drop the cached paid ledger reads after the app writes to paid_showroom.
+# Every INSERT/UPDATE issued by the app calls this, so users see their own writes on the
+# next run; the TTL above only covers changes made outside the app.
+def invalidate_paid_ledger_cache():
+    load_pending_cars_page.clear()
+    load_pending_summary.clear()
+    load_pending_breakdown.clear()
+    load_completed_transactions.clear()
+
+
+# Function to get the keyset cursor (payment_date, id) of the last row of a page
+def pending_page_cursor(page_df):
+    if page_df.empty:
+        return None
+    last_row = page_df.iloc[-1]
+    return pd.to_datetime(last_row['payment_date']).date(), str(last_row['id'])
+
+
+# Callbacks for the pending cars page navigation
+def show_next_pending_page(cursor):
+    if cursor is not None:
+        st.session_state["pending_cursors"].append(cursor)
+
+
+def show_previous_pending_page():
+    if len(st.session_state["pending_cursors"]) > 1:
+        st.session_state["pending_cursors"].pop()
+
+
+# Function to build a set-based UPDATE closing pending paid cars (rows closed by someone else in
+# the meantime are left untouched). The payment dates of the cars are matched along with their
+# ids, so on the partitioned ledger BigQuery only scans the partitions holding them.
+def build_close_cars_query(cars_df, set_clause):
+    query = f"""
+    UPDATE `{paid_showroom_table()}`
+    SET {set_clause}
+    WHERE id IN UNNEST(@car_ids) AND payment_date IN UNNEST(@payment_dates)
+      AND sold_date IS NULL AND return_date IS NULL
+    """
+    parameters = [
+        bigquery.ArrayQueryParameter("car_ids", "STRING", [str(car_id) for car_id in cars_df['id']]),
+        bigquery.ArrayQueryParameter(
+            "payment_dates", "DATE", sorted(set(pd.to_datetime(cars_df['payment_date']).dt.date))
+        )
+    ]
+    return query, parameters
+
+
+# Function to mark paid cars as sold with a single set-based UPDATE
+def mark_cars_sold(cars_df):
+    try:
+        client = get_bigquery_client()
+        if client is None:
+            return False, "Error: No credentials found"
+
+        update_sold_query, parameters = build_close_cars_query(
+            cars_df, "sold_date = CURRENT_DATE()" + status_assignment("sold")
+        )
+        job_config = prepare_ledger_query(client, "mark_cars_sold", update_sold_query, parameters)
+
+        query_job = run_query(client, "mark_cars_sold", update_sold_query, job_config)
+        invalidate_paid_ledger_cache()
+
+        return True, f"تم تحديد {query_job.num_dml_affected_rows or 0} سيارة كمباعة!"
 
     except Exception as e:
-        st.error(f"خطأ في تحميل بيانات السيارات: {str(e)}")
-        return []
+        return False, f"خطأ في تحديد السيارة كمباعة: {str(e)}"
+
+
+# Function to build a script closing pending paid cars like build_close_cars_query, returning the
+# ids it actually closed. The open rows are read and updated in one transaction, so cars closed by
+# someone else in the meantime are never reported back.
+def build_close_cars_returning_query(cars_df, set_clause):
+    query = f"""
+    DECLARE closed_ids ARRAY<STRING>;
+    BEGIN TRANSACTION;
+    SET closed_ids = (
+        SELECT ARRAY_AGG(id) FROM `{paid_showroom_table()}`
+        WHERE id IN UNNEST(@car_ids) AND payment_date IN UNNEST(@payment_dates)
+          AND sold_date IS NULL AND return_date IS NULL
+    );
+    UPDATE `{paid_showroom_table()}`
+    SET {set_clause}
+    WHERE id IN UNNEST(closed_ids) AND payment_date IN UNNEST(@payment_dates)
+      AND sold_date IS NULL AND return_date IS NULL;
+    COMMIT TRANSACTION;
+    SELECT id FROM UNNEST(IFNULL(closed_ids, [])) AS id;
+    """
+    _, parameters = build_close_cars_query(cars_df, set_clause)
+    return query, parameters
+
+
+# Function to build the webhook payload for a returned car
+def build_returned_webhook_payload(car):
+    return {
+        "id": str(car['id']),
+        "c_name": str(car['c_name']),
+        "d_code": str(car['d_code']),
+        "payment_date": str(car['payment_date']),
+        "payment_amount": float(car['payment_amount']),
+        "date_of_payment": str(car['date_of_payment']),
+        "return_date": str(datetime.now().date()),
+        "returned": True,
+        "communication_type": "returned"
+    }
 
 
-# Function to submit discount data to webhook
-def submit_discount_data(discount_data):
+# Function to mark paid cars as returned with a single set-based UPDATE, then notify the webhook
+def mark_cars_returned(cars_df):
     try:
-        webhook_url = "https://anasalaa.app.n8n.cloud/webhook/9296d4cc-ca48-4bd6-9635-3ef4029b0fce"
+        client = get_bigquery_client()
+        if client is None:
+            return False, "Error: No credentials found"
 
-        # Set proper headers for the webhook request
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'User-Agent': 'Streamlit-Showroom-Discount/1.0'
-        }
+        update_returned_query, parameters = build_close_cars_returning_query(
+            cars_df, "returned = TRUE, return_date = CURRENT_DATE()" + status_assignment("returned")
+        )
+        job_config = prepare_ledger_query(client, "mark_cars_returned", update_returned_query, parameters)
 
-        # Debug: Log the payload being sent
-        st.write("🔍 Debug Info:")
-        st.write(f"Webhook URL: {webhook_url}")
-        st.write("Payload being sent:")
-        st.json(discount_data)
+        query_job = run_query(client, "mark_cars_returned", update_returned_query, job_config)
+        invalidate_paid_ledger_cache()
+        returned_ids = {str(row['id']) for row in query_job.result()}
 
-        response = requests.post(webhook_url, json=discount_data, headers=headers, timeout=10)
+    except Exception as e:
+        return False, f"خطأ في تحديد السيارة كمرتجعة: {str(e)}"
+
+    # Queue the returned-car webhooks together, only for the cars this statement returned
+    returned_count = len(returned_ids)
+    payloads = [
+        build_returned_webhook_payload(car) for car in cars_df.to_dict('records')
+        if str(car['id']) in returned_ids
+    ]
+    if not payloads:
+        return True, f"تم تحديد {returned_count} سيارة كمرتجعة!"
+    try:
+        enqueue_webhooks(PAYMENT_WEBHOOK_URL, payloads, kind="returned")
+    except sqlite3.Error as e:
+        return True, f"تم تحديد {returned_count} سيارة كمرتجعة (تعذر جدولة التنبيه: {str(e)})"
+
+    return True, f"تم تحديد {returned_count} سيارة كمرتجعة وتمت جدولة التنبيه!"
+
+
+# Function to open the local webhook outbox (SQLite), creating the table on first use
+def open_webhook_outbox():
+    connection = sqlite3.connect(get_setting("webhook_outbox_path", "webhook_outbox.db"), timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS webhook_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        label TEXT,
+        url TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        headers TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """)
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS webhook_outbox_due ON webhook_outbox (status, next_attempt_at)"
+    )
+    return connection
+
+
+# Function to write webhook payloads to the outbox; the background worker delivers them
+def enqueue_webhooks(webhook_url, payloads, kind, headers=None):
+    now = time.time()
+    rows = [
+        (kind, str(payload.get('c_name') or payload.get('c_code') or ''), webhook_url,
+         json.dumps(payload, default=str), json.dumps(headers or {}), now, now, now)
+        for payload in payloads
+    ]
+
+    with closing(open_webhook_outbox()) as connection, connection:
+        connection.executemany(
+            """
+            INSERT INTO webhook_outbox (kind, label, url, payload, headers, next_attempt_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows
+        )
 
-        # Debug: Log response details
-        st.write(f"Response Status Code: {response.status_code}")
-        st.write(f"Response Headers: {dict(response.headers)}")
+    # Wake the worker so fresh items go out immediately
+    get_webhook_worker().set()
 
-        if response.status_code == 404:
-            return False, f"خطأ 404: الرابط غير موجود. تأكد من أن webhook مُفعل في n8n وأن الرابط صحيح."
 
-        response.raise_for_status()
+# Function to post one webhook payload. Returns None on success, otherwise the error message.
+def deliver_webhook(session, webhook_url, payload, headers=None, timeout=10):
+    try:
+        response = session.post(webhook_url, json=payload, headers=headers or None, timeout=timeout)
 
-        # Log successful response
-        st.write("✅ Response received successfully")
-        if response.text:
-            st.write("Response body:", response.text)
+        if response.status_code == 404:
+            return "خطأ 404: الرابط غير موجود. تأكد من أن webhook مُفعل في n8n وأن الرابط صحيح."
 
-        return True, "تم إرسال بيانات الخصم بنجاح!"
+        response.raise_for_status()
+        return None
 
     except requests.exceptions.Timeout:
-        return False, "خطأ: انتهت مهلة الاتصال. تحقق من اتصال الإنترنت."
+        return "خطأ: انتهت مهلة الاتصال. تحقق من اتصال الإنترنت."
     except requests.exceptions.ConnectionError:
-        return False, "خطأ: فشل في الاتصال بالخادم. تحقق من الرابط."
+        return "خطأ: فشل في الاتصال بالخادم. تحقق من الرابط."
     except requests.exceptions.HTTPError as e:
-        return False, f"خطأ HTTP: {e}. كود الحالة: {e.response.status_code if e.response else 'غير معروف'}"
+        return f"خطأ HTTP: {e}. كود الحالة: {e.response.status_code if e.response is not None else 'غير معروف'}"
     except requests.exceptions.RequestException as e:
-        return False, f"خطأ في إرسال بيانات الخصم: {str(e)}"
-
-
-# Function to submit payment data
-def submit_payment_data(payment_data):
-    try:
-        # Get credentials for BigQuery
+        return f"خطأ في إرسال البيانات: {str(e)}"
+
+
+# Function to build an HTTP session keeping up to pool_size connections alive per host
+def build_webhook_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Function to claim the outbox items that are due for delivery. The claim runs under a write
+# lock (BEGIN IMMEDIATE), so two workers (or processes) sharing the outbox never take the same
+# items. Items left in "sending" longer than lease_seconds (their worker crashed or was
+# restarted) go back to the queue first.
+def claim_due_webhooks(limit, lease_seconds):
+    now = time.time()
+    with closing(open_webhook_outbox()) as connection:
+        connection.execute("BEGIN IMMEDIATE")
         try:
-            credentials = service_account.Credentials.from_service_account_info(
-                st.secrets["service_account"]
+            connection.execute(
+                "UPDATE webhook_outbox SET status = 'pending' WHERE status = 'sending' AND updated_at < ?",
+                (now - lease_seconds,)
             )
-        except (KeyError, FileNotFoundError):
+            rows = connection.execute(
+                """
+                SELECT * FROM webhook_outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+                """,
+                (now, limit)
+            ).fetchall()
+            connection.executemany(
+                "UPDATE webhook_outbox SET status = 'sending', updated_at = ? WHERE id = ?",
+                [(now, row['id']) for row in rows]
+            )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+    return rows
+
+
+# Function to store delivery results: delivered, retried later with backoff, or failed for good
+def record_webhook_results(rows, errors, max_attempts):
+    now = time.time()
+    updates = []
+
+    for row, error in zip(rows, errors):
+        attempts = row['attempts'] + 1
+        if error is None:
+            updates.append(('delivered', attempts, now, None, now, row['id']))
+        elif attempts >= max_attempts:
+            updates.append(('failed', attempts, now, error, now, row['id']))
+        else:
+            delay = min(WEBHOOK_RETRY_BASE_SECONDS * 2 ** (attempts - 1), WEBHOOK_RETRY_MAX_SECONDS)
+            delay *= random.uniform(0.8, 1.2)
+            updates.append(('pending', attempts, now + delay, error, now, row['id']))
+
+    with closing(open_webhook_outbox()) as connection, connection:
+        connection.executemany(
+            """
+            UPDATE webhook_outbox
+            SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            updates
+        )
+
+
+# Background loop that drains the outbox over one pooled HTTP session
+def run_webhook_worker(wake_event, concurrency, max_attempts, poll_seconds, lease_seconds):
+    session = build_webhook_session(concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            wake_event.clear()
             try:
-                credentials = service_account.Credentials.from_service_account_file(
-                    'service_account.json'
+                rows = claim_due_webhooks(limit=concurrency * 4, lease_seconds=lease_seconds)
+                if rows:
+                    errors = list(executor.map(
+                        lambda row: deliver_webhook(
+                            session, row['url'], json.loads(row['payload']), json.loads(row['headers'] or '{}')
+                        ),
+                        rows
+                    ))
+                    record_webhook_results(rows, errors, max_attempts)
+                    continue
+
+                # Keep the outbox small: delivered items are only kept for a week
+                with closing(open_webhook_outbox()) as connection, connection:
+                    connection.execute(
+                        "DELETE FROM webhook_outbox WHERE status = 'delivered' AND updated_at < ?",
+                        (time.time() - 7 * 24 * 3600,)
+                    )
+            except Exception:
+                logging.getLogger(__name__).exception("Webhook outbox worker failed")
+
+            wake_event.wait(poll_seconds)
+
+
+# Function to start the background webhook worker. Returns the event used to wake it up.
+def start_webhook_worker():
+    wake_event = threading.Event()
+    worker = threading.Thread(
+        target=run_webhook_worker,
+        args=(
+            wake_event,
+            get_setting("webhook_concurrency", 4),
+            get_setting("webhook_max_attempts", 8),
+            get_setting("webhook_poll_seconds", 5),
+            # Well above the longest batch (4 rounds of 10 s posts), so live claims never expire
+            get_setting("webhook_lease_seconds", 300)
+        ),
+        name="webhook-outbox-worker",
+        daemon=True
+    )
+    worker.start()
+    return wake_event
+
+
+# Background webhook worker, started once per process (see process_singleton)
+def get_webhook_worker():
+    return process_singleton("webhook_worker", start_webhook_worker)
+
+
+# Function to put failed outbox items back in the queue
+def retry_failed_webhooks():
+    now = time.time()
+    with closing(open_webhook_outbox()) as connection, connection:
+        connection.execute(
+            """
+            UPDATE webhook_outbox
+            SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ?
+            WHERE status = 'failed'
+            """,
+            (now, now)
+        )
+    get_webhook_worker().set()
+
+
+# Function to render the webhook delivery state in the sidebar
+def render_webhook_outbox_status():
+    with st.sidebar.expander("📬 حالة التنبيهات"):
+        try:
+            with closing(open_webhook_outbox()) as connection:
+                counts = dict(connection.execute(
+                    "SELECT status, COUNT(*) FROM webhook_outbox GROUP BY status"
+                ).fetchall())
+                recent_df = pd.read_sql_query(
+                    """
+                    SELECT kind, label, status, attempts, last_error,
+                           datetime(updated_at, 'unixepoch', 'localtime') AS updated_at
+                    FROM webhook_outbox
+                    ORDER BY id DESC
+                    LIMIT 20
+                    """,
+                    connection
                 )
-            except FileNotFoundError:
-                st.error("No credentials found for BigQuery access")
-                return False, "Error: No credentials found"
-
-        # Create BigQuery client
-        client = bigquery.Client(credentials=credentials)
-
-        # Prepare the query - insert into paid_showroom table
-        query = """
-        INSERT INTO `pricing-338819.wholesale_test.paid_showroom`
-        (id, c_name, d_code, payment_date, payment_amount, date_of_payment, 
-         sold_date, returned, return_date, request_id, submitted_by)
-        VALUES
-        (@id, @c_name, @d_code, @payment_date, @payment_amount, @date_of_payment,
-         @sold_date, @returned, @return_date, @request_id, @submitted_by)
-        """
+        except sqlite3.Error as e:
+            st.error(f"خطأ في قراءة قائمة التنبيهات: {str(e)}")
+            return
 
-        # Configure query parameters
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("id", "STRING", payment_data['id']),
-                bigquery.ScalarQueryParameter("c_name", "STRING", payment_data['c_name']),
-                bigquery.ScalarQueryParameter("d_code", "STRING", payment_data['d_code']),
-                bigquery.ScalarQueryParameter("payment_date", "DATE", payment_data['payment_date']),
-                bigquery.ScalarQueryParameter("payment_amount", "NUMERIC", payment_data['payment_amount']),
-                bigquery.ScalarQueryParameter("date_of_payment", "DATE", payment_data['date_of_payment']),
-                bigquery.ScalarQueryParameter("sold_date", "DATE", payment_data['sold_date']),
-                bigquery.ScalarQueryParameter("returned", "BOOL", payment_data['returned']),
-                bigquery.ScalarQueryParameter("return_date", "DATE", payment_data['return_date']),
-                bigquery.ScalarQueryParameter("request_id", "STRING", payment_data['request_id']),
-                bigquery.ScalarQueryParameter("submitted_by", "STRING", payment_data['submitted_by'])
-            ]
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("قيد الإرسال", counts.get('pending', 0) + counts.get('sending', 0))
+        with col2:
+            st.metric("تم الإرسال", counts.get('delivered', 0))
+        with col3:
+            st.metric("فشل", counts.get('failed', 0))
+
+        if not recent_df.empty:
+            st.dataframe(recent_df, hide_index=True, use_container_width=True)
+
+        if counts.get('failed', 0):
+            st.button("🔁 إعادة محاولة الفاشلة", on_click=retry_failed_webhooks, key="retry_failed_webhooks")
+
+
+# Function to build the webhook payload of a discount offer from a discount catalog row
+def build_discount_payload(car, dealer_code):
+    def price(column):
+        return float(car[column]) if pd.notnull(car[column]) and car[column] else 0.0
+
+    def count(column):
+        return None if pd.isnull(car[column]) else int(car[column])
+
+    return {
+        "c_code": str(car['sf_vehicle_name']),
+        "dealer_code": str(dealer_code),
+        "flash_price": price('flash_price'),
+        "consignment_price": price('consignment_price'),
+        "speed_discount_price": price('speed_discount_price'),
+        "days_in_consignment": count('days_in_consignment'),
+        "showroom_displayed_count": count('showroom_displayed_count'),
+        "queue_count": count('queue_count'),
+        "car_status": str(car['car_status'])
+    }
+
+
+# Function to submit discount data to webhook (queued in the outbox, delivered in the background)
+def submit_discount_data(discount_data):
+    # Debug: Log the payload being sent (debug_webhooks setting)
+    if get_setting("debug_webhooks", False):
+        st.write("🔍 Debug Info:")
+        st.write(f"Webhook URL: {DISCOUNT_WEBHOOK_URL}")
+        st.write("Payload being sent:")
+        st.json(discount_data)
+
+    try:
+        enqueue_webhooks(DISCOUNT_WEBHOOK_URL, [discount_data], kind="discount", headers=DISCOUNT_WEBHOOK_HEADERS)
+        return True, "تمت جدولة إرسال بيانات الخصم! تابع حالة الإرسال من قائمة التنبيهات."
+    except sqlite3.Error as e:
+        return False, f"خطأ في جدولة بيانات الخصم: {str(e)}"
+
+
+# Shared HTTP session for sending discount batches right away (kept-alive connections, one per
+# concurrent request)
+@st.cache_resource(show_spinner=False)
+def get_discount_webhook_session():
+    return build_webhook_session(int(get_setting("discount_batch_concurrency", 8)))
+
+
+# Function to send discount payloads right away. With discount_webhook_batch on, the endpoint
+# gets them all in one POST ({"items": [...]}); otherwise each payload is its own POST over the
+# pooled session, with at most discount_batch_concurrency in flight. Failed payloads are queued
+# in the outbox, so the background worker retries them. Returns one error (None if sent) per payload.
+def send_discount_batch(payloads):
+    session = get_discount_webhook_session()
+
+    if get_setting("discount_webhook_batch", False):
+        error = deliver_webhook(
+            session, DISCOUNT_WEBHOOK_URL, {"items": payloads}, DISCOUNT_WEBHOOK_HEADERS, timeout=60
         )
+        errors = [error] * len(payloads)
+    else:
+        with ThreadPoolExecutor(max_workers=int(get_setting("discount_batch_concurrency", 8))) as executor:
+            errors = list(executor.map(
+                lambda payload: deliver_webhook(session, DISCOUNT_WEBHOOK_URL, payload, DISCOUNT_WEBHOOK_HEADERS),
+                payloads
+            ))
+
+    failed_payloads = [payload for payload, error in zip(payloads, errors) if error]
+    if failed_payloads:
+        enqueue_webhooks(DISCOUNT_WEBHOOK_URL, failed_payloads, kind="discount", headers=DISCOUNT_WEBHOOK_HEADERS)
+
+    return errors
+
+
+# Function to build the typed query parameters for a payment row.
+# Both write modes go through these parameters, so the schema and value checks are shared.
+def build_payment_parameters(payment_data):
+    return [
+        bigquery.ScalarQueryParameter("id", "STRING", payment_data['id']),
+        bigquery.ScalarQueryParameter("c_name", "STRING", payment_data['c_name']),
+        bigquery.ScalarQueryParameter("d_code", "STRING", payment_data['d_code']),
+        bigquery.ScalarQueryParameter("payment_date", "DATE", payment_data['payment_date']),
+        bigquery.ScalarQueryParameter("payment_amount", "NUMERIC", payment_data['payment_amount']),
+        bigquery.ScalarQueryParameter("date_of_payment", "DATE", payment_data['date_of_payment']),
+        bigquery.ScalarQueryParameter("sold_date", "DATE", payment_data['sold_date']),
+        bigquery.ScalarQueryParameter("returned", "BOOL", payment_data['returned']),
+        bigquery.ScalarQueryParameter("return_date", "DATE", payment_data['return_date']),
+        bigquery.ScalarQueryParameter("request_id", "STRING", payment_data['request_id']),
+        bigquery.ScalarQueryParameter("submitted_by", "STRING", payment_data['submitted_by'])
+    ] + ([bigquery.ScalarQueryParameter("status", "STRING", "pending")] if paid_showroom_partitioned() else [])
+
+
+# Function to serialize payment parameters to a JSON row (each value exactly as the query
+# parameter would send it), keyed by column name
+def build_payment_row(parameters):
+    return {
+        parameter.name: parameter.to_api_repr()['parameterValue'].get('value')
+        for parameter in parameters
+    }
+
+
+# Function to build the webhook payload for a new payment
+def build_paid_webhook_payload(payment_data):
+    return {
+        "id": payment_data['id'],
+        "c_name": payment_data['c_name'],
+        "d_code": payment_data['d_code'],
+        "payment_date": str(payment_data['payment_date']),
+        "payment_amount": float(payment_data['payment_amount']),
+        "date_of_payment": str(payment_data['date_of_payment']),
+        "submitted_by": payment_data['submitted_by'],
+        "communication_type": "paid"
+    }
+
+
+# Function to insert a payment row with a parameterized DML INSERT job
+def insert_payment_dml(client, parameters):
+    # Prepare the query - insert into paid_showroom table (one column per parameter)
+    columns = [parameter.name for parameter in parameters]
+    query = f"""
+    INSERT INTO `{paid_showroom_table()}`
+    ({", ".join(columns)})
+    VALUES
+    ({", ".join("@" + column for column in columns)})
+    """
+
+    # Execute the query
+    job_config = prepare_ledger_query(client, "insert_payment", query, parameters)
+    run_query(client, "insert_payment", query, job_config)  # Waits for the query to complete
+
+
+# Function to insert a payment row through the streaming (insertAll) API.
+# No query job is scheduled, so the call returns in well under a second and does not count
+# against DML quotas. Note: streamed rows stay in the streaming buffer for a while, and
+# BigQuery rejects UPDATEs touching them until they are flushed, so a car paid in this mode
+# may not be markable as sold/returned right away.
+def insert_payment_streaming(client, parameters):
+    row = build_payment_row(parameters)
+
+    # The payment id doubles as insertId, so a retried submit is de-duplicated by BigQuery
+    started = time.perf_counter()
+    errors = client.insert_rows_json(
+        paid_showroom_table(),
+        [row],
+        row_ids=[row['id']]
+    )
+    record_query_metrics("insert_payment_streaming", time.perf_counter() - started,
+                         error=str(errors) if errors else None)
+    if errors:
+        raise RuntimeError(f"Streaming insert failed: {errors}")
+
+
+# Function to submit payment data.
+# The write path is chosen by the payment_write_mode setting: "dml" (default) or "streaming".
+def submit_payment_data(payment_data):
+    try:
+        # Get the shared BigQuery client
+        client = get_bigquery_client()
+        if client is None:
+            return False, "Error: No credentials found"
+
+        parameters = build_payment_parameters(payment_data)
+
+        if get_setting("payment_write_mode", "dml") == "streaming":
+            insert_payment_streaming(client, parameters)
+        else:
+            insert_payment_dml(client, parameters)
 
-        # Execute the query
-        query_job = client.query(query, job_config=job_config)
-        query_job.result()  # Wait for the query to complete
+        invalidate_paid_ledger_cache()
 
         return True, "تم تقديم بيانات الدفع بنجاح!"
 
@@ -327,519 +2119,1160 @@ def submit_payment_data(payment_data):
         return False, f"خطأ في تقديم بيانات الدفع: {str(e)}"
 
 
-# Main app
-def main():
-    st.title("💰 نموذج بيانات الدفع")
+# Function to read a payment import file (CSV or Excel) with every column as text
+def read_payment_import(uploaded_file):
+    if uploaded_file.name.lower().endswith('.xlsx'):
+        import_df = pd.read_excel(uploaded_file, dtype=str)
+    else:
+        import_df = pd.read_csv(uploaded_file, dtype=str)
+
+    import_df.columns = [str(column).strip() for column in import_df.columns]
+    return import_df
+
+
+# Function to validate a payment import against the cached car and dealer data. Every check is
+# a column-wise operation over the whole file; returns the valid rows (typed) and the rejected
+# rows with their reasons in an "errors" column.
+def validate_payment_import(import_df, cars_df, dealers_df, default_submitter):
+    missing_columns = [column for column in PAYMENT_IMPORT_COLUMNS if column not in import_df.columns]
+    if missing_columns:
+        raise ValueError(f"أعمدة ناقصة في الملف: {', '.join(missing_columns)}")
+
+    if 'submitted_by' in import_df.columns:
+        submitted_by = import_df['submitted_by'].fillna('').str.strip().replace('', default_submitter)
+    else:
+        submitted_by = default_submitter
+
+    payment_dates = pd.to_datetime(import_df['date_of_payment'].str.strip(), format='ISO8601', errors='coerce')
+
+    rows_df = pd.DataFrame({
+        'row': import_df.index + 2,  # Row number in the file (the header is row 1)
+        'c_name': import_df['c_name'].fillna('').str.strip(),
+        'd_code': import_df['d_code'].fillna('').str.strip(),
+        'payment_amount': pd.to_numeric(import_df['payment_amount'].str.replace(',', ''), errors='coerce'),
+        'date_of_payment': payment_dates.dt.date,
+        'submitted_by': submitted_by
+    })
+
+    checks = [
+        (~rows_df['c_name'].isin(cars_df['sf_vehicle_name']), "كود سيارة غير معروف"),
+        (~rows_df['d_code'].isin(dealers_df['dealer_code']), "كود تاجر غير معروف"),
+        (~(rows_df['payment_amount'] > 0), "مبلغ دفع غير صحيح"),
+        (payment_dates.isna(), "تاريخ دفع غير صحيح (YYYY-MM-DD)"),
+        (~rows_df['submitted_by'].isin(SUBMITTER_OPTIONS), "مرسل غير معروف"),
+        (rows_df.duplicated(subset=['c_name', 'd_code', 'payment_amount', 'date_of_payment']), "صف مكرر")
+    ]
+
+    errors = pd.Series('', index=rows_df.index)
+    for failed, message in checks:
+        errors = errors.mask(failed, errors + message + '، ')
+    rows_df['errors'] = errors.str.rstrip('، ')
+
+    rejected = rows_df['errors'] != ''
+    return rows_df[~rejected].drop(columns=['errors']), rows_df[rejected]
+
+
+# Function to get the id of an imported payment: derived from the row contents, so importing the
+# same row again (another session, a reload) gives the same id and is skipped by import_payments
+def import_payment_id(c_name, d_code, payment_amount, date_of_payment):
+    return str(uuid.uuid5(
+        PAYMENT_IMPORT_ID_NAMESPACE, f"{c_name}|{d_code}|{float(payment_amount):.2f}|{date_of_payment.isoformat()}"
+    ))
+
+
+# Function to turn validated import rows into payment records (the same fields as the payment form)
+def build_import_payments(valid_df):
+    return [
+        {
+            'id': import_payment_id(c_name, d_code, payment_amount, date_of_payment),
+            'c_name': c_name,
+            'd_code': d_code,
+            'payment_date': date_of_payment,
+            'payment_amount': float(payment_amount),
+            'date_of_payment': date_of_payment,
+            'sold_date': None,
+            'returned': None,
+            'return_date': None,
+            'request_id': None,
+            'submitted_by': submitted_by
+        }
+        for c_name, d_code, payment_amount, date_of_payment, submitted_by in zip(
+            valid_df['c_name'], valid_df['d_code'], valid_df['payment_amount'],
+            valid_df['date_of_payment'], valid_df['submitted_by']
+        )
+    ]
+
+
+# Function to find which of the given payments are already in paid_showroom (by id; the payment
+# dates are matched too, so the partitioned ledger only scans their partitions)
+def find_existing_payment_ids(client, payments):
+    query = f"""
+    SELECT id
+    FROM `{paid_showroom_table()}`
+    WHERE id IN UNNEST(@payment_ids) AND payment_date IN UNNEST(@payment_dates)
+    """
+    parameters = [
+        bigquery.ArrayQueryParameter("payment_ids", "STRING", [payment['id'] for payment in payments]),
+        bigquery.ArrayQueryParameter("payment_dates", "DATE", sorted({payment['payment_date'] for payment in payments}))
+    ]
+    job_config = prepare_ledger_query(client, "import_existing_ids", query, parameters)
+    return {row['id'] for row in run_query(client, "import_existing_ids", query, job_config).result()}
+
+
+# Function to write imported payments to paid_showroom with a single load job (WRITE_APPEND),
+# then queue all their webhooks in one outbox transaction. Payments already in the ledger
+# (imported before) are skipped, along with their webhooks.
+def import_payments(payments):
+    try:
+        client = get_bigquery_client()
+        if client is None:
+            return False, "Error: No credentials found"
+
+        existing_ids = find_existing_payment_ids(client, payments)
+        skipped_note = f" (تم تخطي {len(existing_ids)} دفعة مستوردة من قبل)" if existing_ids else ""
+        payments = [payment for payment in payments if payment['id'] not in existing_ids]
+        if not payments:
+            return True, f"كل الدفعات في الملف مستوردة من قبل{skipped_note}"
+
+        rows = [build_payment_row(build_payment_parameters(payment)) for payment in payments]
+        job_config = bigquery.LoadJobConfig(
+            schema=PAID_SHOWROOM_SCHEMA + (
+                [bigquery.SchemaField("status", "STRING")] if paid_showroom_partitioned() else []
+            ),
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
 
-    # Load data
-    with st.spinner("جاري تحميل البيانات..."):
-        dealers_data, dealers_dict = load_dealers()
-        cars_data = load_car_names()
-        discount_eligible_cars = load_discount_eligible_cars()
-        discount_data = load_discount_data()
+        started = time.perf_counter()
+        load_job = None
+        try:
+            load_job = client.load_table_from_json(
+                rows, paid_showroom_table(), job_config=job_config
+            )
+            load_job.result()  # Waits for the load job to complete
+        except Exception as e:
+            record_query_metrics("import_payments", time.perf_counter() - started, load_job, error=str(e))
+            raise
+        record_query_metrics("import_payments", time.perf_counter() - started, load_job)
 
-    if not dealers_data:
-        st.warning("لا توجد بيانات متاحة للتجار.")
-        return
+        invalidate_paid_ledger_cache()
 
-    if not cars_data:
-        st.warning("لا توجد بيانات متاحة للسيارات.")
-        return
+        try:
+            enqueue_webhooks(PAYMENT_WEBHOOK_URL, [build_paid_webhook_payload(payment) for payment in payments], kind="paid")
+        except sqlite3.Error as e:
+            return True, f"تم استيراد {len(payments)} دفعة{skipped_note}، لكن تعذر جدولة إشعارات webhook: {str(e)}"
 
-    # Create tabs for form and management
-    tab1, tab2, tab3 = st.tabs(["📝 نموذج الدفع", "📊 إدارة السيارات المدفوعة", "🏷️ خصم المعرض"])
+        return True, f"تم استيراد {len(payments)} دفعة بنجاح!{skipped_note}"
 
-    with tab1:
-        # Generate random ID
-        random_id = str(uuid.uuid4())
+    except Exception as e:
+        return False, f"خطأ في استيراد الدفعات: {str(e)}"
 
-        # Create form
-        with st.form("payment_form"):
-            st.subheader("بيانات الدفع")
 
-            # Show generated ID
-            st.info(f"معرف الدفعة: {random_id}")
+# Function to load reference datasets (the ones a section needs) for the current run.
+# In parallel mode all BigQuery jobs are submitted at once and awaited together, so a cold
+# cache costs the slowest query instead of the sum of all of them. Each loader still runs
+# through its own st.cache_data wrapper, so the same cache entries are filled either way.
+# A loader that fails shows its error here and yields an empty frame for this run only; the
+# failure itself is never cached, so the next run tries BigQuery again.
+def load_reference_data(loaders):
+    if len(loaders) == 1 or not get_setting("parallel_startup_load", True):
+        return [run_reference_loader(loader) for loader in loaders]
 
-            col1, col2 = st.columns(2)
+    ctx = get_script_run_ctx()
 
-            with col1:
-                # Car name dropdown with details
-                car_options = [
-                    (car['sf_vehicle_name'], f"{car['sf_vehicle_name']} - {car['make']} {car['model']} ({car['year']})")
-                    for car in cars_data]
-                car_codes = [code for code, _ in car_options]
-                car_displays = [display for _, display in car_options]
+    def run_loader(loader):
+        # Attach the session context so st.error / st.warning from the loader reach the page
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return loader()
 
-                selected_car_index = st.selectbox(
-                    "اسم العميل",
-                    options=range(len(car_options)),
-                    format_func=lambda i: car_displays[i]
-                )
-                selected_car_name = car_codes[selected_car_index]
-
-                # Payment amount
-                payment_amount = st.number_input(
-                    "مبلغ الدفع",
-                    min_value=0.0,
-                    step=100.0,
-                    format="%.2f"
-                )
+    with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+        futures = [executor.submit(run_loader, loader) for loader in loaders]
+        return [run_reference_loader(loader, future.result) for loader, future in zip(loaders, futures)]
 
-            with col2:
-                # Dealer selection
-                dealer_options = [(dealer['dealer_code'], dealer['dealer_name']) for dealer in dealers_data]
-                dealer_codes = [code for code, _ in dealer_options]
-                dealer_names = [name for _, name in dealer_options]
 
-                selected_dealer_index = st.selectbox(
-                    "كود التاجر",
-                    options=range(len(dealer_options)),
-                    format_func=lambda i: f"{dealer_options[i][0]} - {dealer_options[i][1]}"
-                )
-                selected_dealer_code = dealer_codes[selected_dealer_index]
+# Function to get the result of a reference loader, rendering its error (if any) on the page
+def run_reference_loader(loader, get_result=None):
+    try:
+        return (get_result or loader)()
+    except Exception as e:
+        st.error(f"{REFERENCE_LOAD_ERRORS.get(loader.__name__, 'خطأ في تحميل البيانات')}: {str(e)}")
+        return pd.DataFrame()
 
-                # Date of payment (single date field)
-                date_of_payment = st.date_input(
-                    "تاريخ الدفع",
-                    value=datetime.now().date()
-                )
 
-                # Submitter selection
-                submitter_options = ["Nawal Mostafa", "Mai Yousif", "Mamdouh", "test"]
-                submitted_by = st.selectbox(
-                    "المرسل",
-                    options=submitter_options
-                )
+# Function to render the bulk payment import (upload, validation report, single load job)
+def render_payment_import(dealers_data, cars_data):
+    st.subheader("استيراد دفعات من ملف")
+    st.caption(
+        "الأعمدة المطلوبة: c_name، d_code، payment_amount، date_of_payment (YYYY-MM-DD). "
+        "العمود submitted_by اختياري."
+    )
 
-            # Submit button
-            submit_button = st.form_submit_button("إرسال بيانات الدفع", use_container_width=True)
-
-            if submit_button:
-                # Validate required fields
-                if not payment_amount or payment_amount <= 0:
-                    st.error("يرجى إدخال مبلغ دفع صحيح")
-                    return
-
-                # Prepare payment data
-                payment_data = {
-                    'id': random_id,
-                    'c_name': selected_car_name,
-                    'd_code': selected_dealer_code,
-                    'payment_date': date_of_payment,
-                    'payment_amount': payment_amount,
-                    'date_of_payment': date_of_payment,
-                    'sold_date': None,  # Left blank as requested
-                    'returned': None,  # Left blank as requested
-                    'return_date': None,  # Left blank as requested
-                    'request_id': None,  # Left blank as requested
-                    'submitted_by': submitted_by
-                }
-
-                # Submit payment data
-                success, message = submit_payment_data(payment_data)
-
-                if success:
-                    st.success(message)
-                    st.balloons()
-
-                    # Send HTTP request to webhook for payment
-                    try:
-                        webhook_url = "https://anasalaa.app.n8n.cloud/webhook/e4ddbc51-cbb1-4cff-b88a-1062a3ab2cc7"
-                        webhook_payload = {
-                            "id": payment_data['id'],
-                            "c_name": payment_data['c_name'],
-                            "d_code": payment_data['d_code'],
-                            "payment_date": str(payment_data['payment_date']),
-                            "payment_amount": float(payment_data['payment_amount']),
-                            "date_of_payment": str(payment_data['date_of_payment']),
-                            "submitted_by": payment_data['submitted_by'],
-                            "communication_type": "paid"
-                        }
-
-                        response = requests.post(webhook_url, json=webhook_payload)
-                        response.raise_for_status()
-                    except requests.exceptions.RequestException as e:
-                        st.warning(f"Payment recorded successfully, but webhook notification failed: {str(e)}")
-
-                    # Show submitted data for confirmation
-                    with st.expander("البيانات المرسلة"):
-                        st.json({
-                            "معرف الدفعة": payment_data['id'],
-                            "اسم العميل": payment_data['c_name'],
-                            "كود التاجر": payment_data['d_code'],
-                            "مبلغ الدفع": float(payment_data['payment_amount']),
-                            "تاريخ الدفع": str(payment_data['date_of_payment']),
-                            "المرسل": payment_data['submitted_by']
-                        })
-                else:
-                    st.error(message)
-
-    with tab2:
-        st.subheader("💰 إدارة السيارات المدفوعة")
-
-        # Query to get cars with no sold_date or return_date
-        paid_cars_query = """
-        SELECT 
-            id,
-            c_name,
-            d_code,
-            payment_date,
-            payment_amount,
-            date_of_payment,
-            sold_date,
-            returned,
-            return_date,
-            request_id,
-            submitted_by
-        FROM `pricing-338819.wholesale_test.paid_showroom`
-        WHERE sold_date IS NULL AND return_date IS NULL
-        ORDER BY payment_date DESC
-        """
+    import_col1, import_col2 = st.columns([2, 1])
+    with import_col1:
+        uploaded_file = st.file_uploader("ملف الدفعات (CSV أو Excel)", type=["csv", "xlsx"], key="payment_import_file")
+    with import_col2:
+        default_submitter = st.selectbox("المرسل الافتراضي", options=SUBMITTER_OPTIONS, key="payment_import_submitter")
 
-        try:
-            # Get credentials and create client
-            try:
-                credentials = service_account.Credentials.from_service_account_info(
-                    st.secrets["service_account"]
-                )
-            except (KeyError, FileNotFoundError):
-                try:
-                    credentials = service_account.Credentials.from_service_account_file(
-                        'service_account.json'
-                    )
-                except FileNotFoundError:
-                    st.error("No credentials found for BigQuery access")
-                    credentials = None
-
-            if credentials:
-                client = bigquery.Client(credentials=credentials)
-                paid_cars_df = client.query(paid_cars_query).to_dataframe()
-
-                if not paid_cars_df.empty:
-                    # Display summary metrics
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.metric("السيارات المعلقة", len(paid_cars_df))
-                    with col2:
-                        total_amount = paid_cars_df['payment_amount'].sum()
-                        st.metric("إجمالي المبلغ", f"EGP {total_amount:,.0f}")
-                    with col3:
-                        unique_dealers = len(paid_cars_df['d_code'].unique())
-                        st.metric("التجار الفريدين", unique_dealers)
-
-                    # Display cars with action buttons
-                    for _, car in paid_cars_df.iterrows():
-                        with st.expander(
-                                f"🚗 {car['c_name']} - التاجر: {car['d_code']} - المبلغ: EGP {car['payment_amount']:,.0f}",
-                                expanded=False
-                        ):
-                            col1, col2, col3 = st.columns([2, 1, 1])
-
-                            with col1:
-                                st.write(f"**معرف الدفعة:** {car['id']}")
-                                st.write(f"**اسم السيارة:** {car['c_name']}")
-                                st.write(f"**كود التاجر:** {car['d_code']}")
-                                st.write(f"**تاريخ الدفع:** {car['payment_date']}")
-                                st.write(f"**مبلغ الدفع:** EGP {car['payment_amount']:,.0f}")
-                                st.write(f"**المرسل:** {car.get('submitted_by', 'غير محدد')}")
-
-                            with col2:
-                                if st.button("✅ تم البيع", key=f"sold_{car['id']}"):
-                                    # Update query for sold
-                                    update_sold_query = """
-                                    UPDATE `pricing-338819.wholesale_test.paid_showroom`
-                                    SET sold_date = CURRENT_DATE()
-                                    WHERE id = @car_id
-                                    """
-
-                                    job_config = bigquery.QueryJobConfig(
-                                        query_parameters=[
-                                            bigquery.ScalarQueryParameter("car_id", "STRING", car['id'])
-                                        ]
-                                    )
-
-                                    try:
-                                        query_job = client.query(update_sold_query, job_config=job_config)
-                                        query_job.result()
-                                        st.success(f"تم تحديد السيارة {car['c_name']} كمباعة!")
-                                        st.rerun()
-                                    except Exception as e:
-                                        st.error(f"خطأ في تحديد السيارة كمباعة: {str(e)}")
-
-                            with col3:
-                                if st.button("🔄 تم الإرجاع", key=f"returned_{car['id']}"):
-                                    # Update query for returned
-                                    update_returned_query = """
-                                    UPDATE `pricing-338819.wholesale_test.paid_showroom`
-                                    SET returned = TRUE, return_date = CURRENT_DATE()
-                                    WHERE id = @car_id
-                                    """
-
-                                    job_config = bigquery.QueryJobConfig(
-                                        query_parameters=[
-                                            bigquery.ScalarQueryParameter("car_id", "STRING", car['id'])
-                                        ]
-                                    )
-
-                                    try:
-                                        query_job = client.query(update_returned_query, job_config=job_config)
-                                        query_job.result()
-
-                                        # Send HTTP request to webhook for returned car BEFORE showing success message
-                                        webhook_success = False
-                                        try:
-                                            webhook_url = "https://anasalaa.app.n8n.cloud/webhook/e4ddbc51-cbb1-4cff-b88a-1062a3ab2cc7"
-                                            webhook_payload = {
-                                                "id": str(car['id']),
-                                                "c_name": str(car['c_name']),
-                                                "d_code": str(car['d_code']),
-                                                "payment_date": str(car['payment_date']),
-                                                "payment_amount": float(car['payment_amount']),
-                                                "date_of_payment": str(car['date_of_payment']),
-                                                "return_date": str(datetime.now().date()),
-                                                "returned": True,
-                                                "communication_type": "returned"
-                                            }
-
-                                            response = requests.post(webhook_url, json=webhook_payload, timeout=10)
-                                            response.raise_for_status()
-                                            webhook_success = True
-                                        except requests.exceptions.RequestException as e:
-                                            st.error(f"Webhook error: {str(e)}")
-
-                                        # Show success message
-                                        if webhook_success:
-                                            st.success(f"تم تحديد السيارة {car['c_name']} كمرتجعة وتم إرسال التنبيه!")
-                                        else:
-                                            st.success(f"تم تحديد السيارة {car['c_name']} كمرتجعة (تعذر إرسال التنبيه)")
-
-                                        st.rerun()
-                                    except Exception as e:
-                                        st.error(f"خطأ في تحديد السيارة كمرتجعة: {str(e)}")
-                else:
-                    st.info("�� لا توجد سيارات معلقة! جميع السيارات تم بيعها أو إرجاعها.")
-
-                # Add a section to show completed transactions
-                st.subheader("📊 المعاملات الأخيرة")
-
-                # Query for recent completed transactions
-                completed_query = """
-                SELECT 
-                    id,
-                    c_name,
-                    d_code,
-                    payment_date,
-                    payment_amount,
-                    sold_date,
-                    return_date,
-                    submitted_by,
-                    CASE 
-                        WHEN sold_date IS NOT NULL THEN 'مباع'
-                        WHEN return_date IS NOT NULL THEN 'مرتجع'
-                        ELSE 'معلق'
-                    END as status
-                FROM `pricing-338819.wholesale_test.paid_showroom`
-                WHERE sold_date IS NOT NULL OR return_date IS NOT NULL
-                ORDER BY COALESCE(sold_date, return_date) DESC
-                LIMIT 10
-                """
+    if uploaded_file is None:
+        return
 
-                completed_df = client.query(completed_query).to_dataframe()
+    try:
+        valid_df, rejected_df = validate_payment_import(
+            read_payment_import(uploaded_file), cars_data, dealers_data, default_submitter
+        )
+    except Exception as e:
+        st.error(f"خطأ في قراءة الملف: {str(e)}")
+        return
 
-                if not completed_df.empty:
-                    # Format the dataframe for display
-                    display_df = completed_df.copy()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("عدد الصفوف", len(valid_df) + len(rejected_df))
+    with col2:
+        st.metric("صفوف صالحة", len(valid_df))
+    with col3:
+        st.metric("صفوف مرفوضة", len(rejected_df))
+
+    if not rejected_df.empty:
+        st.warning("الصفوف التالية لن يتم استيرادها:")
+        st.dataframe(
+            rejected_df,
+            column_config={
+                "row": "الصف",
+                "c_name": "اسم السيارة",
+                "d_code": "كود التاجر",
+                "payment_amount": "المبلغ",
+                "date_of_payment": "تاريخ الدفع",
+                "submitted_by": "المرسل",
+                "errors": "الأخطاء"
+            },
+            hide_index=True,
+            use_container_width=True
+        )
 
-                    # Format dates
-                    display_df['payment_date'] = pd.to_datetime(display_df['payment_date']).dt.strftime('%Y-%m-%d')
-                    display_df['sold_date'] = pd.to_datetime(display_df['sold_date']).dt.strftime('%Y-%m-%d')
-                    display_df['return_date'] = pd.to_datetime(display_df['return_date']).dt.strftime('%Y-%m-%d')
+    if valid_df.empty:
+        st.info("لا توجد صفوف صالحة للاستيراد.")
+        return
 
-                    # Format payment amount
-                    display_df['payment_amount'] = display_df['payment_amount'].apply(
-                        lambda x: f"EGP {x:,.0f}" if pd.notnull(x) else "N/A"
-                    )
+    # The same upload is only imported once per session, so a second click cannot duplicate it
+    file_id = getattr(uploaded_file, "file_id", uploaded_file.name)
+    already_imported = file_id in st.session_state.setdefault("imported_payment_files", set())
+    if already_imported:
+        st.info("تم استيراد هذا الملف بالفعل.")
+
+    if st.button(f"📥 استيراد {len(valid_df)} دفعة", disabled=already_imported,
+                 use_container_width=True, key="payment_import_submit"):
+        success, message = import_payments(build_import_payments(valid_df))
+        if success:
+            st.session_state["imported_payment_files"].add(file_id)
+            reload_pending_page()
+            st.success(message)
+        else:
+            st.error(message)
 
-                    st.dataframe(
-                        display_df,
-                        column_config={
-                            "id": "معرف الدفعة",
-                            "c_name": "اسم السيارة",
-                            "d_code": "كود التاجر",
-                            "payment_date": "تاريخ الدفع",
-                            "payment_amount": "المبلغ",
-                            "sold_date": "تاريخ البيع",
-                            "return_date": "تاريخ الإرجاع",
-                            "submitted_by": "المرسل",
-                            "status": "الحالة"
-                        },
-                        use_container_width=True
-                    )
-                else:
-                    st.info("لا توجد معاملات مكتملة حتى الآن.")
 
-        except Exception as e:
-            st.error(f"خطأ في تحميل بيانات المعرض المدفوع: {str(e)}")
+# Function to render the payment form section
+def render_payment_section():
+    # Load data
+    with st.spinner("جاري تحميل البيانات..."):
+        dealers_data, cars_data = load_reference_data([load_dealers, load_car_names])
 
-    with tab3:
-        st.subheader("🏷️ نموذج خصم المعرض")
+    if dealers_data.empty:
+        st.warning("لا توجد بيانات متاحة للتجار.")
+        return
 
-        if not discount_eligible_cars:
-            st.warning("لا توجد سيارات مؤهلة للخصم.")
-            return
+    if cars_data.empty:
+        st.warning("لا توجد بيانات متاحة للسيارات.")
+        return
 
-        if not discount_data:
-            st.warning("لا توجد بيانات خصم متاحة.")
-            return
+    entry_mode = st.radio(
+        "طريقة الإدخال",
+        options=["single", "import"],
+        format_func=lambda mode: "📝 دفعة واحدة" if mode == "single" else "📥 استيراد ملف",
+        horizontal=True,
+        key="payment_entry_mode"
+    )
+    if entry_mode == "import":
+        render_payment_import(dealers_data, cars_data)
+        return
 
-        # Filter cars to only show those that are both discount eligible AND have discount data
-        eligible_cars_with_discount = [
-            car for car in discount_eligible_cars
-            if any(d['c_code'] == car['sf_vehicle_name'] for d in discount_data)
-        ]
+    # Generate random ID
+    random_id = str(uuid.uuid4())
 
-        if not eligible_cars_with_discount:
-            st.warning("لا توجد سيارات مؤهلة للخصم مع بيانات خصم متاحة.")
-            return
+    # Type-ahead search boxes (outside the form so results update before submitting)
+    search_col1, search_col2 = st.columns(2)
+    with search_col1:
+        car_query = st.text_input("🔍 ابحث عن السيارة (الكود، الماركة أو الموديل)", key="payment_car_search")
+    with search_col2:
+        dealer_query = st.text_input("🔍 ابحث عن التاجر (الكود أو الاسم)", key="payment_dealer_search")
+
+    car_matches = search_options("cars", cars_data, car_query)
+    dealer_matches = search_options("dealers", dealers_data, dealer_query)
 
-        # Car selection dropdown - outside of form to allow dynamic updates
-        st.subheader("اختيار السيارة والتاجر")
+    # Create form
+    with st.form("payment_form"):
+        st.subheader("بيانات الدفع")
+
+        # Show generated ID
+        st.info(f"معرف الدفعة: {random_id}")
 
         col1, col2 = st.columns(2)
 
         with col1:
-            # Car selection dropdown - only show cars that are both discount eligible AND have discount data
-            car_options = [
-                (car['sf_vehicle_name'], f"{car['sf_vehicle_name']}  {car['days_in_consignment']} ")
-                for car in eligible_cars_with_discount
-            ]
-            car_codes = [code for code, _ in car_options]
-            car_displays = [display for _, display in car_options]
+            # Car name dropdown with details
+            car_codes = cars_data['sf_vehicle_name'].to_numpy()
+            car_displays = cars_data['option_label'].to_numpy()
 
             selected_car_index = st.selectbox(
-                "اختر السيارة",
-                options=range(len(car_options)),
-                format_func=lambda i: car_displays[i],
-                key="discount_car_select"
+                "اسم العميل",
+                options=car_matches,
+                format_func=lambda i: car_displays[i]
+            )
+
+            # Payment amount
+            payment_amount = st.number_input(
+                "مبلغ الدفع",
+                min_value=0.0,
+                step=100.0,
+                format="%.2f"
             )
-            selected_car_code = car_codes[selected_car_index]
-            selected_car_info = eligible_cars_with_discount[selected_car_index]
 
         with col2:
             # Dealer selection
-            dealer_options = [(dealer['dealer_code'], dealer['dealer_name']) for dealer in dealers_data]
-            dealer_codes = [code for code, _ in dealer_options]
+            dealer_codes = dealers_data['dealer_code'].to_numpy()
+            dealer_displays = dealers_data['option_label'].to_numpy()
 
             selected_dealer_index = st.selectbox(
-                "اختر التاجر",
-                options=range(len(dealer_options)),
-                format_func=lambda i: f"{dealer_options[i][0]} - {dealer_options[i][1]}",
-                key="discount_dealer_select"
+                "كود التاجر",
+                options=dealer_matches,
+                format_func=lambda i: dealer_displays[i]
+            )
+
+            # Date of payment (single date field)
+            date_of_payment = st.date_input(
+                "تاريخ الدفع",
+                value=datetime.now().date()
+            )
+
+            # Submitter selection
+            submitted_by = st.selectbox(
+                "المرسل",
+                options=SUBMITTER_OPTIONS
+            )
+
+        # Submit button
+        submit_button = st.form_submit_button("إرسال بيانات الدفع", use_container_width=True)
+
+        if submit_button:
+            # Validate required fields
+            if selected_car_index is None or selected_dealer_index is None:
+                st.error("يرجى اختيار السيارة والتاجر")
+                return
+
+            if not payment_amount or payment_amount <= 0:
+                st.error("يرجى إدخال مبلغ دفع صحيح")
+                return
+
+            selected_car_name = str(car_codes[selected_car_index])
+            selected_dealer_code = str(dealer_codes[selected_dealer_index])
+
+            # Prepare payment data
+            payment_data = {
+                'id': random_id,
+                'c_name': selected_car_name,
+                'd_code': selected_dealer_code,
+                'payment_date': date_of_payment,
+                'payment_amount': payment_amount,
+                'date_of_payment': date_of_payment,
+                'sold_date': None,  # Left blank as requested
+                'returned': None,  # Left blank as requested
+                'return_date': None,  # Left blank as requested
+                'request_id': None,  # Left blank as requested
+                'submitted_by': submitted_by
+            }
+
+            # Submit payment data
+            success, message = submit_payment_data(payment_data)
+
+            if success:
+                reload_pending_page()
+                st.success(message)
+                st.balloons()
+
+                # Queue the payment webhook; the outbox worker delivers it in the background
+                try:
+                    enqueue_webhooks(PAYMENT_WEBHOOK_URL, [build_paid_webhook_payload(payment_data)], kind="paid")
+                except sqlite3.Error as e:
+                    st.warning(f"Payment recorded successfully, but webhook notification could not be queued: {str(e)}")
+
+                # Show submitted data for confirmation
+                with st.expander("البيانات المرسلة"):
+                    st.json({
+                        "معرف الدفعة": payment_data['id'],
+                        "اسم العميل": payment_data['c_name'],
+                        "كود التاجر": payment_data['d_code'],
+                        "مبلغ الدفع": float(payment_data['payment_amount']),
+                        "تاريخ الدفع": str(payment_data['date_of_payment']),
+                        "المرسل": payment_data['submitted_by']
+                    })
+            else:
+                st.error(message)
+
+
+# Function to get the pending cars page shown to this session. The page is kept in session state,
+# so rows closed from this session are dropped from the local copy instead of reloading the page;
+# it is reloaded when the filters or the cursor change, after this session adds payments, or
+# after the ledger cache TTL.
+def get_pending_page(pending_filters, cursor):
+    page_key = (pending_filters, cursor)
+    local_page = st.session_state.get("pending_page")
+
+    if local_page is None or local_page["key"] != page_key or time.time() - local_page["loaded_at"] > 300:
+        page_df, has_next_page = load_pending_cars_page(*pending_filters, cursor)
+        local_page = {
+            "key": page_key,
+            "rows": page_df,
+            "has_next": has_next_page,
+            # Taken before any row is removed, so the next page starts after the whole loaded page
+            "next_cursor": pending_page_cursor(page_df),
+            "loaded_at": time.time()
+        }
+        st.session_state["pending_page"] = local_page
+
+    return local_page
+
+
+# Callback for the sold / returned actions of the pending cars list. It runs before the
+# fragment reruns; on success the closed rows are removed from the local page copy.
+def close_pending_cars(action, car_ids):
+    local_page = st.session_state["pending_page"]
+    page_df = local_page["rows"]
+
+    if action == "sold":
+        success, message = mark_cars_sold(page_df[page_df['id'].isin(car_ids)])
+    else:
+        success, message = mark_cars_returned(page_df[page_df['id'].isin(car_ids)])
+
+    if success:
+        local_page["rows"] = page_df[~page_df['id'].isin(car_ids)]
+    st.session_state["pending_action_result"] = (success, message)
+
+
+# Function to drop the local page copy, so the next run reloads it from BigQuery. Used as the
+# reload button callback and after payments are submitted or imported.
+def reload_pending_page():
+    st.session_state.pop("pending_page", None)
+
+
+# Function to render the pending cars summary, actions and page navigation.
+# This is a fragment: a click on a row or bulk action reruns only this function, not the
+# whole script (loaders, filters, completed transactions).
+@st.fragment
+def render_pending_cars(pending_filters):
+    dealer_filter, submitter_filter, date_from, date_to, page_size = pending_filters
+    pending_cursors = st.session_state["pending_cursors"]
+
+    # Outcome of the last row action (set by close_pending_cars)
+    action_result = st.session_state.pop("pending_action_result", None)
+    if action_result is not None:
+        success, message = action_result
+        if success:
+            st.success(message)
+        else:
+            st.error(message)
+
+    pending_summary = load_pending_summary(dealer_filter, submitter_filter, date_from, date_to)
+    local_page = get_pending_page(pending_filters, pending_cursors[-1])
+    paid_cars_df, has_next_page = local_page["rows"], local_page["has_next"]
+
+    if pending_summary['pending_count'] > 0:
+        # Display summary metrics
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("السيارات المعلقة", pending_summary['pending_count'])
+        with col2:
+            st.metric("إجمالي المبلغ", f"EGP {pending_summary['total_amount']:,.0f}")
+        with col3:
+            st.metric("التجار الفريدين", pending_summary['unique_dealers'])
+
+        # Optional breakdown of the same metrics (its own aggregate query)
+        breakdown_by = st.radio(
+            "تفصيل الملخص",
+            options=[None] + list(PENDING_BREAKDOWN_COLUMNS),
+            format_func=lambda column: "بدون" if column is None else PENDING_BREAKDOWN_COLUMNS[column],
+            horizontal=True,
+            key="pending_breakdown_by"
+        )
+        if breakdown_by is not None:
+            breakdown_df = load_pending_breakdown(
+                breakdown_by, dealer_filter, submitter_filter, date_from, date_to
+            )
+            st.dataframe(
+                breakdown_df.rename(columns={
+                    'group_key': 'التاجر' if breakdown_by == 'd_code' else 'المرسل',
+                    'pending_count': 'السيارات المعلقة',
+                    'total_amount': 'إجمالي المبلغ',
+                    'unique_dealers': 'التجار الفريدين'
+                }),
+                hide_index=True,
+                use_container_width=True
             )
-            selected_dealer_code = dealer_codes[selected_dealer_index]
 
-        # Find discount data for selected car
-        car_discount = next((d for d in discount_data if d['c_code'] == selected_car_code), None)
+        if paid_cars_df.empty:
+            st.info("لا توجد سيارات في هذه الصفحة.")
+            st.button("🔄 تحديث الصفحة", on_click=reload_pending_page, key="pending_reload_page")
+
+        # Bulk actions on the selected cars of this page (one UPDATE per action)
+        if not paid_cars_df.empty:
+            page_labels = {
+                car_id: f"{c_name} - {d_code} - EGP {amount:,.0f}"
+                for car_id, c_name, d_code, amount in zip(
+                    paid_cars_df['id'], paid_cars_df['c_name'],
+                    paid_cars_df['d_code'], paid_cars_df['payment_amount']
+                )
+            }
+            # The key follows the page content so a stale selection never outlives its rows
+            selection_key = f"pending_selection_{hash(tuple(page_labels))}"
+
+            select_all = st.checkbox("تحديد كل سيارات الصفحة", key=f"{selection_key}_all")
+            selected_ids = st.multiselect(
+                "السيارات المحددة",
+                options=list(page_labels),
+                default=list(page_labels) if select_all else [],
+                format_func=lambda car_id: page_labels[car_id],
+                key=selection_key
+            )
 
-        if car_discount:
-            st.subheader("معلومات الخصم")
+            bulk_col1, bulk_col2 = st.columns(2)
+            with bulk_col1:
+                st.button(f"✅ تم بيع المحدد ({len(selected_ids)})", disabled=not selected_ids,
+                          use_container_width=True, key="bulk_sold",
+                          on_click=close_pending_cars, args=("sold", selected_ids))
+            with bulk_col2:
+                st.button(f"🔄 تم إرجاع المحدد ({len(selected_ids)})", disabled=not selected_ids,
+                          use_container_width=True, key="bulk_returned",
+                          on_click=close_pending_cars, args=("returned", selected_ids))
+
+        # Display cars with action buttons
+        for _, car in paid_cars_df.iterrows():
+            with st.expander(
+                    f"🚗 {car['c_name']} - التاجر: {car['d_code']} - المبلغ: EGP {car['payment_amount']:,.0f}",
+                    expanded=False
+            ):
+                col1, col2, col3 = st.columns([2, 1, 1])
+
+                with col1:
+                    st.write(f"**معرف الدفعة:** {car['id']}")
+                    st.write(f"**اسم السيارة:** {car['c_name']}")
+                    st.write(f"**كود التاجر:** {car['d_code']}")
+                    st.write(f"**تاريخ الدفع:** {car['payment_date']}")
+                    st.write(f"**مبلغ الدفع:** EGP {car['payment_amount']:,.0f}")
+                    st.write(f"**المرسل:** {car.get('submitted_by', 'غير محدد')}")
+
+                with col2:
+                    st.button("✅ تم البيع", key=f"sold_{car['id']}",
+                              on_click=close_pending_cars, args=("sold", [car['id']]))
+
+                with col3:
+                    st.button("🔄 تم الإرجاع", key=f"returned_{car['id']}",
+                              on_click=close_pending_cars, args=("returned", [car['id']]))
+
+        # Page navigation (keyset cursors are kept in session state)
+        total_pages = max(1, -(-pending_summary['pending_count'] // page_size))
+        nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
+        with nav_col1:
+            st.button(
+                "→ السابق",
+                disabled=len(pending_cursors) == 1,
+                on_click=show_previous_pending_page,
+                key="pending_previous_page"
+            )
+        with nav_col2:
+            st.caption(f"صفحة {len(pending_cursors)} من {total_pages}")
+        with nav_col3:
+            st.button(
+                "التالي ←",
+                disabled=not has_next_page,
+                on_click=show_next_pending_page,
+                args=(local_page["next_cursor"],),
+                key="pending_next_page"
+            )
+    else:
+        st.info("�� لا توجد سيارات معلقة! جميع السيارات تم بيعها أو إرجاعها.")
 
-            col1, col2, col3, col4 = st.columns(4)
 
-            with col1:
-                st.metric(
-                    "السعر السريع",
-                    f"EGP {car_discount['speed_discount_price']:,.0f}" if car_discount[
-                        'speed_discount_price'] else "غير متاح"
+# Function to render the paid cars management section
+def render_paid_management_section():
+    # Load data (the dealers are only needed for the filter labels)
+    with st.spinner("جاري تحميل البيانات..."):
+        dealers_data, = load_reference_data([load_dealers])
+
+    if dealers_data.empty:
+        st.warning("لا توجد بيانات متاحة للتجار.")
+        return
+
+    st.subheader("💰 إدارة السيارات المدفوعة")
+
+    try:
+        # Get the shared BigQuery client
+        client = get_bigquery_client()
+
+        if client is not None:
+            # Filters for the pending cars listing (applied in SQL, not in pandas)
+            filter_col1, filter_col2, filter_col3, filter_col4 = st.columns(4)
+
+            with filter_col1:
+                dealer_filter = st.selectbox(
+                    "التاجر",
+                    options=[None] + dealers_data['dealer_code'].tolist(),
+                    format_func=lambda code: "الكل" if code is None else dealers_data.at[code, 'option_label'],
+                    key="pending_dealer_filter"
                 )
 
-            with col2:
-                st.metric(
-                    "سعر الاستلام",
-                    f"EGP {car_discount['consignment_price']:,.0f}" if car_discount['consignment_price'] else "غير متاح"
+            with filter_col2:
+                submitter_filter = st.selectbox(
+                    "المرسل",
+                    options=[None] + SUBMITTER_OPTIONS,
+                    format_func=lambda name: "الكل" if name is None else name,
+                    key="pending_submitter_filter"
                 )
 
-            with col3:
-                if car_discount['speed_discount_price'] and car_discount['consignment_price']:
-                    discount_amount = car_discount['consignment_price'] - car_discount['speed_discount_price']
-                    st.metric("مبلغ الخصم", f"EGP {discount_amount:,.0f}")
-                else:
-                    st.metric("مبلغ الخصم", "غير متاح")
+            with filter_col3:
+                date_range = st.date_input("نطاق تاريخ الدفع", value=(), key="pending_date_filter")
+                date_from = date_range[0] if len(date_range) > 0 else None
+                date_to = date_range[1] if len(date_range) > 1 else None
+
+            with filter_col4:
+                default_page_size = get_setting("pending_page_size", 25)
+                page_size = st.selectbox(
+                    "عدد السيارات في الصفحة",
+                    options=PENDING_PAGE_SIZE_OPTIONS,
+                    index=PENDING_PAGE_SIZE_OPTIONS.index(default_page_size)
+                    if default_page_size in PENDING_PAGE_SIZE_OPTIONS else 1,
+                    key="pending_page_size"
+                )
+
+            # Go back to the first page whenever the filters change
+            pending_filters = (dealer_filter, submitter_filter, date_from, date_to, page_size)
+            if st.session_state.get("pending_filters") != pending_filters:
+                st.session_state["pending_filters"] = pending_filters
+                st.session_state["pending_cursors"] = [None]
+
+            render_pending_cars(pending_filters)
+
+            # Add a section to show completed transactions
+            st.subheader("📊 المعاملات الأخيرة")
+
+            completed_df = load_completed_transactions()
+
+            if not completed_df.empty:
+                # Format the dataframe for display
+                display_df = completed_df.copy()
+
+                # Format dates
+                display_df['payment_date'] = pd.to_datetime(display_df['payment_date']).dt.strftime('%Y-%m-%d')
+                display_df['sold_date'] = pd.to_datetime(display_df['sold_date']).dt.strftime('%Y-%m-%d')
+                display_df['return_date'] = pd.to_datetime(display_df['return_date']).dt.strftime('%Y-%m-%d')
 
-            with col4:
-                st.metric(
-                    "السعر الفوري",
-                    f"EGP {car_discount['flash_price']:,.0f}" if car_discount['flash_price'] else "غير متاح"
+                # Format payment amount
+                display_df['payment_amount'] = display_df['payment_amount'].apply(
+                    lambda x: f"EGP {x:,.0f}" if pd.notnull(x) else "N/A"
                 )
 
-            # Car details
-            st.subheader("تفاصيل السيارة")
-            col1, col2, col3 = st.columns(3)
-
-            with col1:
-                st.info(f"**أيام الاستلام:** {selected_car_info['days_in_consignment']}")
-
-            with col2:
-                st.info(f"**عدد مرات العرض:** {selected_car_info['showroom_displayed_count']}")
-
-            with col3:
-                st.info(f"**عدد الطوابير:** {selected_car_info['queue_count']}")
-
-            # Create form for submission
-            with st.form("discount_form"):
-                st.subheader("تأكيد إرسال بيانات الخصم")
-
-                # Show summary of what will be sent
-                st.info(f"**السيارة المختارة:** {selected_car_code}")
-                st.info(f"**التاجر المختار:** {selected_dealer_code}")
-
-                # Submit button
-                submit_discount = st.form_submit_button("إرسال بيانات الخصم", use_container_width=True)
-
-                if submit_discount:
-                    # Prepare discount payload
-                    discount_payload = {
-                        "c_code": selected_car_code,
-                        "dealer_code": selected_dealer_code,
-                        "flash_price": float(car_discount['flash_price']) if car_discount['flash_price'] else 0.0,
-                        "consignment_price": float(car_discount['consignment_price']) if car_discount[
-                            'consignment_price'] else 0.0,
-                        "speed_discount_price": float(car_discount['speed_discount_price']) if car_discount[
-                            'speed_discount_price'] else 0.0,
-                        "days_in_consignment": selected_car_info['days_in_consignment'],
-                        "showroom_displayed_count": selected_car_info['showroom_displayed_count'],
-                        "queue_count": selected_car_info['queue_count'],
-                        "car_status": selected_car_info['car_status']
-                    }
-
-                    # Submit to webhook
-                    success, message = submit_discount_data(discount_payload)
-
-                    if success:
-                        st.success(message)
-                        st.balloons()
-
-                        # Show submitted data for confirmation
-                        with st.expander("البيانات المرسلة"):
-                            st.json({
-                                "كود السيارة": discount_payload['c_code'],
-                                "كود التاجر": discount_payload['dealer_code'],
-                                "السعر الفوري": discount_payload['flash_price'],
-                                "سعر الاستلام": discount_payload['consignment_price'],
-                                "السعر السريع": discount_payload['speed_discount_price'],
-                                "أيام الاستلام": discount_payload['days_in_consignment'],
-                                "عدد مرات العرض": discount_payload['showroom_displayed_count'],
-                                "عدد الطوابير": discount_payload['queue_count'],
-                                "حالة السيارة": discount_payload['car_status']
-                            })
-                    else:
-                        st.error(message)
+                st.dataframe(
+                    display_df,
+                    column_config={
+                        "id": "معرف الدفعة",
+                        "c_name": "اسم السيارة",
+                        "d_code": "كود التاجر",
+                        "payment_date": "تاريخ الدفع",
+                        "payment_amount": "المبلغ",
+                        "sold_date": "تاريخ البيع",
+                        "return_date": "تاريخ الإرجاع",
+                        "submitted_by": "المرسل",
+                        "status": "الحالة"
+                    },
+                    use_container_width=True
+                )
+            else:
+                st.info("لا توجد معاملات مكتملة حتى الآن.")
+
+            render_ledger_export(client, dealers_data)
+
+    except Exception as e:
+        st.error(f"خطأ في تحميل بيانات المعرض المدفوع: {str(e)}")
+
+
+# Function to render the table of every discount eligible car, with column-wise filters.
+# Sorting is done by the table itself (click a column header); selected rows can be sent in a batch.
+def render_discount_fleet_table(discount_catalog, dealers_data):
+    filter_col1, filter_col2, filter_col3, filter_col4 = st.columns(4)
+
+    with filter_col1:
+        code_query = st.text_input("🔍 كود السيارة", key="fleet_code_filter")
+    with filter_col2:
+        status_filter = st.multiselect(
+            "حالة السيارة",
+            options=sorted(discount_catalog['car_status'].dropna().astype(str).unique()),
+            key="fleet_status_filter"
+        )
+    with filter_col3:
+        min_days = st.number_input("أقل عدد أيام استلام", min_value=0, step=1, key="fleet_min_days")
+    with filter_col4:
+        min_discount_pct = st.number_input("أقل نسبة خصم %", min_value=0.0, step=1.0, key="fleet_min_discount_pct")
+
+    # Cars without a day count (NULL) are only left out once a minimum is set
+    mask = pd.Series(True, index=discount_catalog.index)
+    if min_days:
+        mask &= (discount_catalog['days_in_consignment'] >= min_days).fillna(False).astype(bool)
+    if code_query:
+        mask &= discount_catalog['sf_vehicle_name'].astype(str).str.contains(code_query.strip(), case=False, regex=False)
+    if status_filter:
+        mask &= discount_catalog['car_status'].astype(str).isin(status_filter)
+    if min_discount_pct:
+        mask &= discount_catalog['discount_pct'] >= min_discount_pct
+
+    fleet_df = discount_catalog.loc[mask, [
+        'sf_vehicle_name', 'car_status', 'days_in_consignment', 'showroom_displayed_count', 'queue_count',
+        'consignment_price', 'speed_discount_price', 'flash_price', 'discount_amount', 'discount_pct'
+    ]]
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("عدد السيارات", f"{len(fleet_df):,}")
+    with col2:
+        average_discount_pct = fleet_df['discount_pct'].mean()
+        st.metric("متوسط نسبة الخصم", "غير متاح" if pd.isnull(average_discount_pct) else f"{average_discount_pct:.1f}%")
+    with col3:
+        st.metric("إجمالي مبالغ الخصم", f"EGP {fleet_df['discount_amount'].sum():,.0f}")
+
+    # The key follows the filters, so selected row positions never point into another table
+    fleet_filters = (code_query, tuple(status_filter), min_days, min_discount_pct)
+    fleet_selection = st.dataframe(
+        fleet_df,
+        column_config={
+            "sf_vehicle_name": "كود السيارة",
+            "car_status": "الحالة",
+            "days_in_consignment": st.column_config.NumberColumn("أيام الاستلام", format="%d"),
+            "showroom_displayed_count": st.column_config.NumberColumn("عدد مرات العرض", format="%d"),
+            "queue_count": st.column_config.NumberColumn("عدد الطوابير", format="%d"),
+            "consignment_price": st.column_config.NumberColumn("سعر الاستلام", format="EGP %.0f"),
+            "speed_discount_price": st.column_config.NumberColumn("السعر السريع", format="EGP %.0f"),
+            "flash_price": st.column_config.NumberColumn("السعر الفوري", format="EGP %.0f"),
+            "discount_amount": st.column_config.NumberColumn("مبلغ الخصم", format="EGP %.0f"),
+            "discount_pct": st.column_config.NumberColumn("نسبة الخصم", format="%.1f%%")
+        },
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="multi-row",
+        key=f"fleet_table_{hash(fleet_filters)}"
+    )
+
+    render_discount_batch(discount_catalog.loc[fleet_df.index[fleet_selection.selection.rows]], dealers_data)
+
+
+# Function to render the batch discount submission for the cars selected in the fleet table:
+# every selected car is offered to every selected dealer
+def render_discount_batch(selected_cars_df, dealers_data):
+    st.subheader("إرسال خصم لعدة سيارات")
+
+    if selected_cars_df.empty:
+        st.info("حدد السيارات من الجدول لإرسال الخصم لها.")
+        return
+
+    # Type-ahead dealer search: only the matches (plus the dealers already picked, so they stay
+    # selected across searches) are sent to the browser, not the whole dealer list
+    batch_dealer_query = st.text_input("🔍 ابحث عن التاجر (الكود أو الاسم)", key="discount_batch_dealer_search")
+    picked_dealers = [
+        code for code in st.session_state.get("discount_batch_dealers", []) if code in dealers_data.index
+    ]
+    st.session_state["discount_batch_dealers"] = picked_dealers
+    matched_dealers = dealers_data['dealer_code'].iloc[
+        search_options("dealers", dealers_data, batch_dealer_query)
+    ].tolist()
+    selected_dealers = st.multiselect(
+        "التجار",
+        options=picked_dealers + [code for code in matched_dealers if code not in picked_dealers],
+        format_func=lambda code: dealers_data.at[code, 'option_label'],
+        key="discount_batch_dealers"
+    )
+    submit_batch = st.button(
+        f"إرسال الخصم ({len(selected_cars_df)} سيارة)", use_container_width=True, key="discount_batch_submit"
+    )
+
+    if not submit_batch:
+        return
 
+    if not selected_dealers:
+        st.error("يرجى اختيار تاجر واحد على الأقل")
+        return
+
+    payloads = [
+        build_discount_payload(car, dealer_code)
+        for car in selected_cars_df.to_dict('records')
+        for dealer_code in selected_dealers
+    ]
+    max_items = int(get_setting("discount_batch_max_items", 500))
+    if len(payloads) > max_items:
+        st.error(f"عدد العناصر ({len(payloads)}) أكبر من الحد المسموح ({max_items}). قلل عدد السيارات أو التجار.")
+        return
+
+    try:
+        with st.spinner(f"جاري إرسال {len(payloads)} عنصر..."):
+            errors = send_discount_batch(payloads)
+    except sqlite3.Error as e:
+        st.error(f"تعذر جدولة العناصر الفاشلة لإعادة المحاولة: {str(e)}")
+        return
+
+    failed_count = sum(1 for error in errors if error)
+    if failed_count:
+        st.warning(f"تم إرسال {len(payloads) - failed_count} من {len(payloads)}. "
+                   f"تمت جدولة {failed_count} عنصر فاشل لإعادة المحاولة تلقائياً.")
+    else:
+        st.success(f"تم إرسال {len(payloads)} عنصر بنجاح!")
+
+    st.dataframe(
+        pd.DataFrame({
+            "كود السيارة": [payload['c_code'] for payload in payloads],
+            "كود التاجر": [payload['dealer_code'] for payload in payloads],
+            "النتيجة": ["✅ تم الإرسال" if error is None else f"❌ {error}" for error in errors]
+        }),
+        hide_index=True,
+        use_container_width=True
+    )
+
+
+# Function to render the showroom discount section
+def render_discount_section():
+    # Load data
+    with st.spinner("جاري تحميل البيانات..."):
+        dealers_data, discount_eligible_cars, discount_data = load_reference_data(
+            [load_dealers, load_discount_eligible_cars, load_discount_data]
+        )
+
+    if dealers_data.empty:
+        st.warning("لا توجد بيانات متاحة للتجار.")
+        return
+
+    st.subheader("🏷️ نموذج خصم المعرض")
+
+    if discount_eligible_cars.empty:
+        st.warning("لا توجد سيارات مؤهلة للخصم.")
+        return
+
+    if discount_data.empty:
+        st.warning("لا توجد بيانات خصم متاحة.")
+        return
+
+    # Cars that are both discount eligible AND have discount data, pre-joined and indexed by code
+    eligible_cars_with_discount = load_discount_catalog(
+        discount_eligible_cars.attrs.get('generation', len(discount_eligible_cars)),
+        discount_data.attrs.get('generation', len(discount_data)),
+        discount_eligible_cars,
+        discount_data
+    )
+
+    if eligible_cars_with_discount.empty:
+        st.warning("لا توجد سيارات مؤهلة للخصم مع بيانات خصم متاحة.")
+        return
+
+    discount_view = st.radio(
+        "طريقة العرض",
+        options=["single", "fleet"],
+        format_func=lambda view: "🚗 سيارة واحدة" if view == "single" else "📋 كل السيارات المؤهلة",
+        horizontal=True,
+        key="discount_view"
+    )
+    if discount_view == "fleet":
+        render_discount_fleet_table(eligible_cars_with_discount, dealers_data)
+        return
+
+    # Car selection dropdown - outside of form to allow dynamic updates
+    st.subheader("اختيار السيارة والتاجر")
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        # Car selection dropdown - only show cars that are both discount eligible AND have discount data
+        car_codes = eligible_cars_with_discount['sf_vehicle_name'].to_numpy()
+        car_displays = eligible_cars_with_discount['option_label'].to_numpy()
+
+        discount_car_query = st.text_input("🔍 ابحث عن السيارة", key="discount_car_search")
+        selected_car_index = st.selectbox(
+            "اختر السيارة",
+            options=search_options("discount_cars", eligible_cars_with_discount, discount_car_query),
+            format_func=lambda i: car_displays[i],
+            key="discount_car_select"
+        )
+
+    with col2:
+        # Dealer selection
+        dealer_codes = dealers_data['dealer_code'].to_numpy()
+        dealer_displays = dealers_data['option_label'].to_numpy()
+
+        discount_dealer_query = st.text_input("🔍 ابحث عن التاجر", key="discount_dealer_search")
+        selected_dealer_index = st.selectbox(
+            "اختر التاجر",
+            options=search_options("dealers", dealers_data, discount_dealer_query),
+            format_func=lambda i: dealer_displays[i],
+            key="discount_dealer_select"
+        )
+
+    if selected_car_index is None or selected_dealer_index is None:
+        st.info("لا توجد نتائج مطابقة للبحث.")
+        return
+
+    selected_car_code = str(car_codes[selected_car_index])
+    selected_car_info = eligible_cars_with_discount.loc[selected_car_code].to_dict()
+    selected_dealer_code = str(dealer_codes[selected_dealer_index])
+
+    # Discount data for the selected car comes from the same pre-joined row
+    car_discount = selected_car_info
+
+    st.subheader("معلومات الخصم")
+
+    col1, col2, col3, col4 = st.columns(4)
+
+    with col1:
+        st.metric(
+            "السعر السريع",
+            f"EGP {car_discount['speed_discount_price']:,.0f}" if car_discount[
+                'speed_discount_price'] else "غير متاح"
+        )
+
+    with col2:
+        st.metric(
+            "سعر الاستلام",
+            f"EGP {car_discount['consignment_price']:,.0f}" if car_discount['consignment_price'] else "غير متاح"
+        )
+
+    with col3:
+        if pd.notnull(car_discount['discount_amount']):
+            st.metric("مبلغ الخصم", f"EGP {car_discount['discount_amount']:,.0f}",
+                      f"{car_discount['discount_pct']:.1f}%", delta_color="off")
         else:
-            st.error(f"لا توجد بيانات خصم للسيارة {selected_car_code}")
+            st.metric("مبلغ الخصم", "غير متاح")
+
+    with col4:
+        st.metric(
+            "السعر الفوري",
+            f"EGP {car_discount['flash_price']:,.0f}" if car_discount['flash_price'] else "غير متاح"
+        )
+
+    # Car details
+    st.subheader("تفاصيل السيارة")
+    col1, col2, col3 = st.columns(3)
+
+    with col1:
+        st.info(f"**أيام الاستلام:** {selected_car_info['days_in_consignment']}")
+
+    with col2:
+        st.info(f"**عدد مرات العرض:** {selected_car_info['showroom_displayed_count']}")
+
+    with col3:
+        st.info(f"**عدد الطوابير:** {selected_car_info['queue_count']}")
+
+    # Create form for submission
+    with st.form("discount_form"):
+        st.subheader("تأكيد إرسال بيانات الخصم")
+
+        # Show summary of what will be sent
+        st.info(f"**السيارة المختارة:** {selected_car_code}")
+        st.info(f"**التاجر المختار:** {selected_dealer_code}")
+
+        # Submit button
+        submit_discount = st.form_submit_button("إرسال بيانات الخصم", use_container_width=True)
+
+        if submit_discount:
+            # Prepare discount payload
+            discount_payload = build_discount_payload(selected_car_info, selected_dealer_code)
+
+            # Submit to webhook
+            success, message = submit_discount_data(discount_payload)
+
+            if success:
+                st.success(message)
+                st.balloons()
+
+                # Show submitted data for confirmation
+                with st.expander("البيانات المرسلة"):
+                    st.json({
+                        "كود السيارة": discount_payload['c_code'],
+                        "كود التاجر": discount_payload['dealer_code'],
+                        "السعر الفوري": discount_payload['flash_price'],
+                        "سعر الاستلام": discount_payload['consignment_price'],
+                        "السعر السريع": discount_payload['speed_discount_price'],
+                        "أيام الاستلام": discount_payload['days_in_consignment'],
+                        "عدد مرات العرض": discount_payload['showroom_displayed_count'],
+                        "عدد الطوابير": discount_payload['queue_count'],
+                        "حالة السيارة": discount_payload['car_status']
+                    })
+            else:
+                st.error(message)
+
+
+# App sections: key -> (navigation label, render function)
+APP_SECTIONS = {
+    "payment": ("📝 نموذج الدفع", render_payment_section),
+    "paid_management": ("📊 إدارة السيارات المدفوعة", render_paid_management_section),
+    "discount": ("🏷️ خصم المعرض", render_discount_section)
+}
+
+
+# Main app
+def main():
+    st.title("💰 نموذج بيانات الدفع")
+
+    # Start draining webhooks left in the outbox by earlier runs, and show their state
+    get_webhook_worker()
+    render_webhook_outbox_status()
+
+    # Start the query metrics (and the scrape endpoint, when metrics_port is set)
+    get_query_metrics()
+    render_query_metrics_panel()
+
+    # With navigation_mode = "tabs" every section runs on every rerun (st.tabs renders them all).
+    # The default "lazy" mode only runs the selected section, so a keystroke in one section
+    # does not query or compute the data of the others.
+    if get_setting("navigation_mode", "lazy") == "tabs":
+        tabs = st.tabs([label for label, _ in APP_SECTIONS.values()])
+        for tab, (_, render_section) in zip(tabs, APP_SECTIONS.values()):
+            with tab:
+                render_section()
+        return
+
+    section = st.radio(
+        "القسم",
+        options=list(APP_SECTIONS),
+        format_func=lambda key: APP_SECTIONS[key][0],
+        horizontal=True,
+        label_visibility="collapsed",
+        key="active_section"
+    )
+    APP_SECTIONS[section][1]()
+
+
+# Function to parse a YYYY-MM-DD command line argument
+def parse_cli_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+# Command line entry points: python main.py <command> [options]
+def run_cli(argv):
+    parser = argparse.ArgumentParser(prog="main.py", description="Paid showroom maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    snapshot_parser = subparsers.add_parser(
+        "build-car-snapshot",
+        help="Materialize the wholesale car catalog into the snapshot table (run it on a schedule)"
+    )
+    snapshot_parser.add_argument("--local", metavar="PATH", help="Write a local Parquet file instead of the table")
+    snapshot_parser.add_argument("--every", type=float, metavar="MINUTES",
+                                 help="Keep running and rebuild the snapshot every MINUTES")
+
+    migrate_parser = subparsers.add_parser(
+        "migrate-paid-ledger",
+        help="Copy paid_showroom into a table partitioned by payment month and clustered on (status, id)"
+    )
+    migrate_parser.add_argument("--target", metavar="TABLE", help="New table (default: <ledger>_partitioned)")
+    migrate_parser.add_argument("--swap", action="store_true",
+                                help="Rename the old table to <name>_legacy_<date> and the new one to the ledger name")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="Print the DDL and the bytes it would scan")
+
+    export_parser = subparsers.add_parser(
+        "export-ledger",
+        help="Stream the paid ledger history to a CSV or Parquet file"
+    )
+    export_parser.add_argument("output", metavar="OUTPUT", help="File to write (.csv or .parquet)")
+    export_parser.add_argument("--format", choices=["csv", "parquet"],
+                               help="File format (default: from the OUTPUT extension)")
+    export_parser.add_argument("--from", dest="date_from", type=parse_cli_date, metavar="YYYY-MM-DD",
+                               help="First payment date")
+    export_parser.add_argument("--to", dest="date_to", type=parse_cli_date, metavar="YYYY-MM-DD",
+                               help="Last payment date")
+    export_parser.add_argument("--dealer", metavar="CODE", help="Dealer code")
+    export_parser.add_argument("--status", choices=list(LEDGER_EXPORT_STATUSES), help="Ledger status")
+
+    budget_parser = subparsers.add_parser(
+        "check-scan-budget",
+        help="Dry-run every paid ledger query and fail if one would scan more than the budget"
+    )
+    budget_parser.add_argument("--budget", type=int, metavar="BYTES",
+                               help="Byte budget per query (default: the scan_budget_bytes setting)")
+
+    catalog_scan_parser = subparsers.add_parser(
+        "check-car-catalog-scan",
+        help="Dry-run the full and incremental car catalog queries and print the bytes each would scan"
+    )
+    catalog_scan_parser.add_argument("--since-hours", type=float, default=1, metavar="HOURS",
+                                     help="Watermarks of the incremental query, in hours before now (default: 1)")
+
+    args = parser.parse_args(argv)
+
+    client = get_bigquery_client()
+    if client is None:
+        print("No credentials found for BigQuery access", file=sys.stderr)
+        return 1
+
+    if args.command == "build-car-snapshot":
+        while True:
+            try:
+                row_count = build_car_snapshot(client, local_path=args.local)
+            except Exception:
+                if not args.every:
+                    raise
+                # A scheduled builder outlives transient failures; the next run tries again
+                logging.getLogger(__name__).exception("Car snapshot build failed")
+            else:
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} car snapshot built: {row_count} cars "
+                      f"-> {args.local or get_setting('car_snapshot_table', CAR_SNAPSHOT_TABLE)}")
+            if not args.every:
+                return 0
+            time.sleep(args.every * 60)
+
+    if args.command == "migrate-paid-ledger":
+        for line in migrate_paid_ledger(client, target=args.target, swap=args.swap, dry_run=args.dry_run):
+            print(line)
+        return 0
+
+    if args.command == "export-ledger":
+        file_format = args.format or ("parquet" if args.output.lower().endswith(".parquet") else "csv")
+        row_count = export_paid_ledger(
+            client, args.output, file_format, date_from=args.date_from, date_to=args.date_to,
+            dealer_code=args.dealer, status=args.status
+        )
+        print(f"{row_count} rows -> {args.output}")
+        return 0
+
+    if args.command == "check-scan-budget":
+        budget_bytes = args.budget if args.budget is not None else int(get_setting("scan_budget_bytes", 0))
+        over_budget = False
+        for name, query, parameters in build_ledger_budget_queries():
+            try:
+                scanned_bytes = check_scan_budget(client, name, query, parameters, budget_bytes)
+                print(f"ok    {name}: {scanned_bytes:,} bytes")
+            except RuntimeError as e:
+                over_budget = True
+                print(f"FAIL  {e}")
+        return 1 if over_budget else 0
+
+    if args.command == "check-car-catalog-scan":
+        watermark = pd.Timestamp.now(tz='UTC') - pd.Timedelta(hours=args.since_hours)
+        for name, query, parameters in [
+            ("car_catalog_full", build_car_catalog_query(), []),
+            ("car_catalog_incremental", build_car_catalog_incremental_query(),
+             catalog_watermark_parameters(client, watermark, watermark))
+        ]:
+            print(f"{name}: {check_scan_budget(client, name, query, parameters):,} bytes")
+        return 0
+
+    return 0
 
 
 if __name__ == "__main__":
+    # `python main.py <command>` runs a maintenance command; `streamlit run main.py` runs the app
+    if len(sys.argv) > 1 and get_script_run_ctx() is None:
+        sys.exit(run_cli(sys.argv[1:]))
+
     # Set Arabic RTL layout
     st.markdown("""
     <style>